@@ -5,6 +5,7 @@ import time
 import zipfile
 from io import BytesIO
 import sys
+import bedrock_invoker
 
 suffix = random.randrange(200, 900)
 boto3_session = boto3.session.Session()
@@ -479,50 +480,39 @@ def create_bedrock_execution_role_multi_ds(bucket_names):
 
 # Converse API invoke model
 def invoke_bedrock_model(client, id, prompt, max_tokens=2000, temperature=0, top_p=0.9):
-    response = ""
-    try:
-        response = client.converse(
-            modelId=id,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "text": prompt
-                        }
-                    ]
-                }
-            ],
-            inferenceConfig={
-                "temperature": temperature,
-                "maxTokens": max_tokens,
-                "topP": top_p
+    # throttling is retried by bedrock_invoker, any other error is raised to the caller
+    response = bedrock_invoker.converse(
+        id,
+        [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "text": prompt
+                    }
+                ]
             }
-            #additionalModelRequestFields={
-            #}
-        )
-    except Exception as e:
-        print(e)
-        result = "Model invocation error"
-    try:
-        result = response['output']['message']['content'][0]['text'] \
-        + '\n--- Latency: ' + str(response['metrics']['latencyMs']) \
-        + 'ms - Input tokens:' + str(response['usage']['inputTokens']) \
-        + ' - Output tokens:' + str(response['usage']['outputTokens']) + ' ---\n'
-        return result
-    except Exception as e:
-        print(e)
-        result = "Output parsing error"
+        ],
+        client=client,
+        inferenceConfig={
+            "temperature": temperature,
+            "maxTokens": max_tokens,
+            "topP": top_p
+        }
+    )
+    result = response['output']['message']['content'][0]['text'] \
+    + '\n--- Latency: ' + str(response['metrics']['latencyMs']) \
+    + 'ms - Input tokens:' + str(response['usage']['inputTokens']) \
+    + ' - Output tokens:' + str(response['usage']['outputTokens']) + ' ---\n'
     return result
 
 
 # Converse API streaming
 def invoke_bedrock_model_stream(client, id, prompt, 
                                 max_tokens=2000, temperature=0, top_p=0.9):
-    response = ""
-    response = client.converse_stream(
-        modelId=id,
-        messages=[
+    response = bedrock_invoker.converse_stream(
+        id,
+        [
             {
                 "role": "user",
                 "content": [
@@ -532,6 +522,7 @@ def invoke_bedrock_model_stream(client, id, prompt,
                 ]
             }
         ],
+        client=client,
         inferenceConfig={
             "temperature": temperature,
             "maxTokens": max_tokens,
@@ -1,22 +1,15 @@
-import json
 import boto3
-from botocore.config import Config
+import bedrock_invoker
 from PIL import Image, ImageDraw
 import copy
 from io import BytesIO
 import base64
 import yaml
 
-boto_config = Config(
-        connect_timeout=1, read_timeout=300,
-        retries={'max_attempts': 1})
-
 boto_session = boto3.Session()
 
-bedrock_runtime = boto_session.client(
-    service_name="bedrock-runtime",
-    config=boto_config
-)
+# throttling retries, rate limits and metrics are handled by bedrock_invoker
+bedrock_runtime = bedrock_invoker.get_client()
 
 s3 = boto_session.client('s3')
 
@@ -68,24 +61,21 @@ def get_text_response(image_base64=None, text_query="What is in this image?"):
 
     content.append(query_obj)
 
-    body = json.dumps(
-        {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 10000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": content,
-                }
-            ],
-        }
-    )
-
-    response = bedrock_runtime.invoke_model(
-        modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-        body=body)
-    
-    response_body = json.loads(response.get("body").read())
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 10000,
+        "messages": [
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+    }
+
+    response_body = bedrock_invoker.invoke_model(
+        "anthropic.claude-3-sonnet-20240229-v1:0",
+        body,
+        client=bedrock_runtime)
 
     return response_body
 
@@ -0,0 +1,429 @@
+import json
+import random
+import threading
+import time
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# single entry point for the Bedrock runtime calls of the labs:
+# - per-model token buckets on requests/min and tokens/min (unlimited until set_model_limits is called)
+# - exponential backoff with full jitter, on throttling / capacity errors only
+# - a per-model circuit breaker that fails fast once a model keeps failing
+# - per-model metrics (get_metrics / reset_metrics)
+
+# botocore retries are turned off (max_attempts counts the retries, total_max_attempts includes the first call),
+# retries happen here so every attempt goes through the rate limits and the metrics
+boto_config = Config(
+        connect_timeout=5, read_timeout=300,
+        retries={'total_max_attempts': 1})
+
+# errors worth retrying, everything else (validation, access denied, ...) is raised on the first attempt
+THROTTLING_ERRORS = {'ThrottlingException', 'TooManyRequestsException'}
+RETRYABLE_ERRORS = THROTTLING_ERRORS | {'ServiceUnavailableException', 'ModelNotReadyException'}
+
+MAX_RETRIES = 8
+BASE_DELAY = 1
+MAX_DELAY = 60
+
+# consecutive failed calls that open the breaker, and seconds before a trial call is let through
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+# payload fields holding base64 media, they are not prompt text and are left out of the token estimate
+BINARY_FIELDS = {'bytes', 'data', 'image', 'images', 'inputImage', 'init_image'}
+
+METRICS = [
+    'calls',
+    'successes',
+    'failures',
+    'throttles',
+    'retries',
+    'circuit_rejections',
+    'input_tokens',
+    'output_tokens',
+    'rate_limit_wait_s',
+    'backoff_s',
+    'latency_s',
+]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    # holds up to one minute worth of units and refills continuously
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # block until `amount` units are available, returns the seconds waited
+    def acquire(self, amount=1):
+        # a request larger than the bucket would never fit, it waits for a full bucket instead
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return waited
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    # give back (positive) or charge (negative) units once the actual usage is known
+    def adjust(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class CircuitBreaker:
+    # closed -> open after failure_threshold consecutive failures -> half-open after reset_timeout,
+    # where a single trial call decides between closed and open again
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.trial or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    # returns True when the call is the half-open trial
+    def before_call(self, model_id):
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            if self.trial or time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"Circuit open for {model_id} after {self.failures} consecutive failures")
+            self.trial = True
+            return True
+
+    # a trial interrupted before its outcome was recorded (KeyboardInterrupt, ...) lets the next call try again
+    def end_trial(self):
+        with self.lock:
+            self.trial = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+
+# per-model limits, breaker and metrics
+_lock = threading.Lock()
+_models = {}
+_client = {}
+
+
+def get_client(region_name=None):
+    with _lock:
+        if region_name not in _client:
+            _client[region_name] = boto3.Session().client(
+                service_name='bedrock-runtime', region_name=region_name, config=boto_config)
+        return _client[region_name]
+
+
+def _allows_retries(client):
+    retries = client.meta.config.retries or {}
+    if 'total_max_attempts' in retries:
+        return retries['total_max_attempts'] > 1
+    # botocore retries by default when max_attempts is not set
+    return retries.get('max_attempts', 1) > 0
+
+
+# a caller client that retries on its own (e.g. a plain boto3.client('bedrock-runtime')) would hide throttling
+# from the buckets, metrics and breaker and multiply the retries, the shared client of its region is used instead
+def _resolve_client(client):
+    if client is None:
+        return get_client()
+    if _allows_retries(client):
+        return get_client(client.meta.region_name)
+    return client
+
+
+def _get_model(model_id):
+    with _lock:
+        if model_id not in _models:
+            _models[model_id] = {
+                'requests': None,
+                'tokens': None,
+                'breaker': CircuitBreaker(),
+                'metrics': {key: 0 for key in METRICS},
+            }
+        return _models[model_id]
+
+
+def _count(model, **counters):
+    with _lock:
+        for key, value in counters.items():
+            model['metrics'][key] += value
+
+
+def set_model_limits(model_id, requests_per_minute=None, tokens_per_minute=None,
+                     failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+    """
+    Sets the client-side rate limits and circuit breaker of a model.
+
+    Args:
+        model_id (str): The model (or inference profile) id the limits apply to.
+        requests_per_minute (int): Requests per minute, None for no limit.
+        tokens_per_minute (int): Input + output tokens per minute, None for no limit.
+        failure_threshold (int): Consecutive failed calls that open the circuit breaker.
+        reset_timeout (float): Seconds the breaker stays open before a trial call.
+    """
+    model = _get_model(model_id)
+    with _lock:
+        model['requests'] = TokenBucket(requests_per_minute) if requests_per_minute else None
+        model['tokens'] = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        model['breaker'] = CircuitBreaker(failure_threshold, reset_timeout)
+
+
+def get_metrics(model_id=None):
+    with _lock:
+        metrics = {
+            key: dict(model['metrics'], circuit=model['breaker'].state)
+            for key, model in _models.items()
+        }
+    for values in metrics.values():
+        values['avg_latency_ms'] = round(1000 * values['latency_s'] / values['successes'], 1) if values['successes'] else 0
+    if model_id is not None:
+        return metrics.get(model_id)
+    return metrics
+
+
+def reset_metrics():
+    with _lock:
+        for model in _models.values():
+            model['metrics'] = {key: 0 for key in METRICS}
+
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get('Error', {}).get('Code')
+    return None
+
+
+# request errors of the caller (4xx other than throttling) say nothing about the health of the model
+def _is_caller_error(error):
+    if not isinstance(error, ClientError) or error_code(error) in RETRYABLE_ERRORS:
+        return False
+    status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+    return 400 <= status < 500
+
+
+def _text_length(value):
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(_text_length(item) for key, item in value.items() if key not in BINARY_FIELDS)
+    if isinstance(value, (list, tuple)):
+        return sum(_text_length(item) for item in value)
+    return 0
+
+
+# rough token count of a request (4 characters per token) plus the output budget,
+# the tokens/min bucket is corrected with the actual usage after the call
+def estimate_tokens(request):
+    max_tokens = (
+        request.get('max_tokens')
+        or request.get('inferenceConfig', {}).get('maxTokens')
+        or request.get('textGenerationConfig', {}).get('maxTokenCount')
+        or 0
+    )
+    return _text_length(request) // 4 + max_tokens
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+
+
+def _call(model_id, request, send):
+    model = _get_model(model_id)
+    estimate = estimate_tokens(request)
+    _count(model, calls=1)
+
+    try:
+        trial = model['breaker'].before_call(model_id)
+    except CircuitOpenError:
+        _count(model, circuit_rejections=1)
+        raise
+
+    try:
+        return _send_with_retries(model_id, model, estimate, send)
+    finally:
+        if trial:
+            model['breaker'].end_trial()
+
+
+def _send_with_retries(model_id, model, estimate, send):
+    attempt = 0
+    while True:
+        waited = 0.0
+        if model['requests'] is not None:
+            waited += model['requests'].acquire(1)
+        if model['tokens'] is not None:
+            waited += model['tokens'].acquire(estimate)
+        _count(model, rate_limit_wait_s=waited)
+
+        start = time.monotonic()
+        try:
+            result, input_tokens, output_tokens = send()
+        except Exception as e:
+            # a rejected request consumed no tokens
+            if model['tokens'] is not None:
+                model['tokens'].adjust(estimate)
+
+            code = error_code(e)
+            if code in THROTTLING_ERRORS:
+                _count(model, throttles=1)
+            if code in RETRYABLE_ERRORS and attempt < MAX_RETRIES:
+                delay = _backoff(attempt)
+                attempt += 1
+                print(f"{code} on {model_id}, retrying in {delay:.2f}s (attempt {attempt}/{MAX_RETRIES})")
+                _count(model, retries=1, backoff_s=delay)
+                time.sleep(delay)
+                continue
+
+            _count(model, failures=1)
+            if _is_caller_error(e):
+                model['breaker'].record_success()
+            else:
+                model['breaker'].record_failure()
+            raise
+
+        if model['tokens'] is not None:
+            model['tokens'].adjust(estimate - input_tokens - output_tokens)
+        model['breaker'].record_success()
+        _count(model, successes=1, input_tokens=input_tokens, output_tokens=output_tokens,
+               latency_s=time.monotonic() - start)
+        return result
+
+
+def invoke_model(model_id, body, client=None, accept='application/json', content_type='application/json'):
+    """
+    Calls InvokeModel through the rate limits, retries and circuit breaker of the model.
+
+    Args:
+        model_id (str): The model (or inference profile) id.
+        body (dict or str): The native request body of the model.
+        client: An optional bedrock-runtime client without botocore retries, the shared client by default.
+
+    Returns:
+        dict: The parsed response body.
+    """
+    client = _resolve_client(client)
+    request = json.loads(body) if isinstance(body, str) else body
+    payload = body if isinstance(body, str) else json.dumps(body)
+
+    def send():
+        response = client.invoke_model(body=payload, modelId=model_id, accept=accept, contentType=content_type)
+        response_body = json.loads(response.get('body').read())
+
+        # every model reports its token counts in the response headers, the body is the fallback
+        headers = response.get('ResponseMetadata', {}).get('HTTPHeaders', {})
+        usage = response_body.get('usage', {}) if isinstance(response_body, dict) else {}
+        input_tokens = int(
+            headers.get('x-amzn-bedrock-input-token-count')
+            or usage.get('input_tokens')
+            or usage.get('inputTokens')
+            or (response_body.get('inputTextTokenCount') if isinstance(response_body, dict) else 0)
+            or 0
+        )
+        output_tokens = int(
+            headers.get('x-amzn-bedrock-output-token-count')
+            or usage.get('output_tokens')
+            or usage.get('outputTokens')
+            or 0
+        )
+        return response_body, input_tokens, output_tokens
+
+    return _call(model_id, request, send)
+
+
+def converse(model_id, messages, client=None, **kwargs):
+    """
+    Calls the Converse API through the rate limits, retries and circuit breaker of the model.
+
+    Args:
+        model_id (str): The model (or inference profile) id.
+        messages (list): The conversation messages.
+        client: An optional bedrock-runtime client without botocore retries, the shared client by default.
+        **kwargs: Other Converse parameters (system, inferenceConfig, additionalModelRequestFields, ...).
+
+    Returns:
+        dict: The Converse response.
+    """
+    client = _resolve_client(client)
+    request = dict(kwargs, messages=messages)
+
+    def send():
+        response = client.converse(modelId=model_id, messages=messages, **kwargs)
+        usage = response.get('usage', {})
+        return response, usage.get('inputTokens', 0), usage.get('outputTokens', 0)
+
+    return _call(model_id, request, send)
+
+
+def converse_stream(model_id, messages, client=None, **kwargs):
+    """
+    Calls the ConverseStream API, only opening the stream is retried.
+
+    Args:
+        model_id (str): The model (or inference profile) id.
+        messages (list): The conversation messages.
+        client: An optional bedrock-runtime client without botocore retries, the shared client by default.
+        **kwargs: Other ConverseStream parameters.
+
+    Returns:
+        dict: The ConverseStream response, its 'stream' records the token usage once consumed.
+    """
+    client = _resolve_client(client)
+    request = dict(kwargs, messages=messages)
+    model = _get_model(model_id)
+
+    # the usage only arrives in the metadata event at the end of the stream
+    def send():
+        return client.converse_stream(modelId=model_id, messages=messages, **kwargs), 0, 0
+
+    response = _call(model_id, request, send)
+    stream = response['stream']
+
+    def record_usage():
+        for event in stream:
+            if 'metadata' in event:
+                usage = event['metadata'].get('usage', {})
+                input_tokens = usage.get('inputTokens', 0)
+                output_tokens = usage.get('outputTokens', 0)
+                _count(model, input_tokens=input_tokens, output_tokens=output_tokens)
+                if model['tokens'] is not None:
+                    model['tokens'].adjust(-input_tokens - output_tokens)
+            yield event
+
+    return dict(response, stream=record_usage())
@@ -1,23 +1,22 @@
 import json
 import boto3
-from botocore.config import Config
 from botocore.exceptions import NoCredentialsError
 import io
 import base64
 from PIL import Image
 import random
 import uuid
-
-boto_config = Config(
-        connect_timeout=1, read_timeout=300,
-        retries={'max_attempts': 1})
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from vector_profiles import quantize_vector, quantize_vectors, fit_byte_scale
+from opensearch_util import fuse_results
+import bedrock_invoker
 
 boto_session = boto3.Session()
 
-bedrock_runtime = boto_session.client(
-    service_name="bedrock-runtime",
-    config=boto_config
-)
+# throttling retries, rate limits and metrics are handled by bedrock_invoker
+bedrock_runtime = bedrock_invoker.get_client()
 
 s3 = boto_session.client('s3')
 
@@ -83,16 +82,7 @@ def get_mm_embedding(image_base64=None, text_description=None, model_id="amazon.
     if not input_data:
         raise ValueError("At least one of image_base64 or text_description must be provided")
 
-    body = json.dumps(input_data)
-
-    response = bedrock_runtime.invoke_model(
-        body=body,
-        modelId=model_id,
-        accept="application/json",
-        contentType="application/json"
-    )
-
-    response_body = json.loads(response.get("body").read())
+    response_body = bedrock_invoker.invoke_model(model_id, input_data, client=bedrock_runtime)
     return response_body.get("embedding")
 
 
@@ -114,16 +104,7 @@ def get_text_embedding(text, model_id="cohere.embed-english-v3"):
         input_data["texts"] = [text]
         input_data["input_type"] = "search_document"
 
-    body = json.dumps(input_data)
-
-    response = bedrock_runtime.invoke_model(
-        body=body,
-        modelId=model_id,
-        accept="application/json",
-        contentType="application/json"
-    )
-
-    response_body = json.loads(response.get("body").read())
+    response_body = bedrock_invoker.invoke_model(model_id, input_data, client=bedrock_runtime)
 
     if model_id == "amazon.titan-embed-text-v1":
         return response_body.get('embedding')
@@ -149,10 +130,9 @@ def get_image_response(json_body):
 
     model_id='stability.stable-diffusion-xl-v1'
 
-    response = bedrock_runtime.invoke_model(
-        body=json.dumps(json_body), modelId=model_id, accept=accept, contentType=content_type
+    response_body = bedrock_invoker.invoke_model(
+        model_id, json_body, client=bedrock_runtime, accept=accept, content_type=content_type
     )
-    response_body = json.loads(response.get("body").read())
     print(response_body['result'])
 
     base64_image = response_body.get("artifacts")[0].get("base64")
@@ -188,24 +168,21 @@ def get_text_response(image_base64=None, text_query="What is in this image?"):
 
     content.append(query_obj)
 
-    body = json.dumps(
-        {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 10000,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": content,
-                }
-            ],
-        }
-    )
-
-    response = bedrock_runtime.invoke_model(
-        modelId="anthropic.claude-3-sonnet-20240229-v1:0",
-        body=body)
-    
-    response_body = json.loads(response.get("body").read())
+    body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": 10000,
+        "messages": [
+            {
+                "role": "user",
+                "content": content,
+            }
+        ],
+    }
+
+    response_body = bedrock_invoker.invoke_model(
+        "anthropic.claude-3-sonnet-20240229-v1:0",
+        body,
+        client=bedrock_runtime)
 
     return response_body
 
@@ -253,8 +230,170 @@ def random_split(data, pct=0.8):
     return training_data, validation_data
 
 
+# embed a query with the same model as the index, quantized like the indexed vectors (see vector_profiles)
+def get_query_embedding(query, model_id=None, vector_profile="float32", scale=None):
+    if model_id == "amazon.titan-embed-text-v2:0":
+        embedding = get_text_embedding(query, model_id="amazon.titan-embed-text-v2:0")
+    else:
+        embedding = get_mm_embedding(text_description=query)
+    return quantize_vector(embedding, vector_profile, scale)
+
+
+# quantize the document vectors like the index stores them, byte vectors get a scale fitted on the documents
+# unless one is given, returns the new documents and the scale to quantize the queries with
+def quantize_documents(docs, vector_profile="float32", scale=None, vector_field="vector_field"):
+    if vector_profile == "float32" or not docs:
+        return list(docs), scale
+
+    vectors = [doc[vector_field] for doc in docs]
+    if vector_profile == "byte" and scale is None:
+        scale = fit_byte_scale(vectors)
+
+    quantized = quantize_vectors(vectors, vector_profile, scale)
+    return [{**doc, vector_field: vector} for doc, vector in zip(docs, quantized)], scale
+
+
+# titan embedding models take one input per request, so the queries are embedded concurrently
+def batch_query_embeddings(queries, model_id=None, max_workers=8, vector_profile="float32", scale=None):
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(lambda query: get_query_embedding(query, model_id, vector_profile, scale), queries))
+
+
+# build a new knn query body from the os_query template, the template is not modified
+def build_knn_query(os_query, vector, top_k):
+    vector_field, knn = next(iter(os_query["query"]["knn"].items()))
+    return {
+        **os_query,
+        "size": top_k,
+        "query": {
+            "knn": {
+                vector_field: {**knn, "vector": vector, "k": top_k}
+            }
+        }
+    }
+
+
+#evaluate top hits with batched embeddings and _msearch
+def evaluate_top_hit_batched(os_manager, os_query, dataset, index_name, top_k=5, model_id=None, batch_size=50, max_workers=8,
+                             vector_profile="float32", scale=None):
+    queries = dataset["queries"]
+    mapping = dataset["relevant_docs"]
+
+    q_ids = list(queries.keys())
+    vectors = batch_query_embeddings([queries[q_id] for q_id in q_ids], model_id=model_id, max_workers=max_workers,
+                                     vector_profile=vector_profile, scale=scale)
+
+    search_bodies = [build_knn_query(os_query, vector, top_k) for vector in vectors]
+    results = os_manager.opensearch_msearch(search_bodies, index_name=index_name, batch_size=batch_size)
+
+    eval_results = []
+    for q_id, hits in zip(q_ids, results):
+        retrieved_ids = [value["_source"]["id"] for value in hits]
+
+        expected_id = mapping[q_id][0]
+
+        eval_results.append({
+            'is_hit': expected_id in retrieved_ids,  # assume 1 relevant doc
+            'retrieved': retrieved_ids,
+            'expected': expected_id,
+            'query': q_id,
+        })
+    return eval_results
+
+
+# hit rate, recall, MRR and nDCG at every cutoff, each query is embedded and searched once at max(ks)
+def evaluate_retrieval(os_manager, os_query, dataset, index_name, ks=(1, 5, 10), model_id=None, batch_size=50,
+                       vector_profile="float32", scale=None):
+    ks = sorted(set(ks))
+    max_k = ks[-1]
+
+    eval_results = evaluate_top_hit_batched(os_manager, os_query, dataset, index_name, top_k=max_k, model_id=model_id, batch_size=batch_size,
+                                            vector_profile=vector_profile, scale=scale)
+    mapping = dataset["relevant_docs"]
+
+    return compute_retrieval_metrics(
+        [eval_result['retrieved'] for eval_result in eval_results],
+        [mapping[eval_result['query']] for eval_result in eval_results],
+        ks
+    )
+
+
+def compute_retrieval_metrics(retrieved, relevant_docs, ks=(1, 5, 10)):
+    ks = sorted(set(ks))
+    max_k = ks[-1]
+
+    # binary relevance of the ranked results, padded to max_k
+    relevance = np.zeros((len(retrieved), max_k), dtype=bool)
+    num_relevant = np.zeros(len(retrieved))
+    for i, (retrieved_ids, relevant_ids) in enumerate(zip(retrieved, relevant_docs)):
+        relevant = set(relevant_ids)
+        num_relevant[i] = len(relevant)
+        for j, doc_id in enumerate(retrieved_ids[:max_k]):
+            relevance[i, j] = doc_id in relevant
+
+    ranks = np.arange(1, max_k + 1)
+    discounts = 1 / np.log2(ranks + 1)
+    first_hit = np.where(relevance.any(axis=1), relevance.argmax(axis=1) + 1, max_k + 1)
+
+    rows = []
+    for k in ks:
+        top = relevance[:, :k]
+        dcg = (top * discounts[:k]).sum(axis=1)
+        ideal = np.cumsum(discounts[:k])[np.minimum(num_relevant, k).astype(int) - 1]
+        rows.append({
+            'k': k,
+            'hit_rate': top.any(axis=1).mean(),
+            'recall': (top.sum(axis=1) / np.maximum(num_relevant, 1)).mean(),
+            'mrr': np.where(first_hit <= k, 1 / first_hit, 0).mean(),
+            'ndcg': np.where(num_relevant > 0, dcg / ideal, 0).mean(),
+        })
+
+    return pd.DataFrame(rows).set_index('k')
+
+
+HYBRID_CONFIGS = [
+    {'name': 'knn', 'fusion': 'rrf', 'weights': (0.0, 1.0)},
+    {'name': 'bm25', 'fusion': 'rrf', 'weights': (1.0, 0.0)},
+    {'name': 'rrf', 'fusion': 'rrf', 'weights': (1.0, 1.0)},
+    {'name': 'weighted 0.3/0.7', 'fusion': 'weighted', 'weights': (0.3, 0.7)},
+    {'name': 'weighted 0.5/0.5', 'fusion': 'weighted', 'weights': (0.5, 0.5)},
+]
+
+
+# compare kNN, BM25 and fused rankings, the candidates are fetched once and fused per configuration
+def evaluate_hybrid(os_manager, dataset, index_name, ks=(1, 5, 10), model_id=None, text_fields=("caption",),
+                    vector_field="vector_field", configs=HYBRID_CONFIGS, num_candidates=None, rrf_k=60,
+                    vector_profile="float32", scale=None):
+    queries = dataset["queries"]
+    mapping = dataset["relevant_docs"]
+    max_k = max(ks)
+
+    q_ids = list(queries.keys())
+    texts = [queries[q_id] for q_id in q_ids]
+    vectors = batch_query_embeddings(texts, model_id=model_id, vector_profile=vector_profile, scale=scale)
+
+    candidates = os_manager.hybrid_candidates(index_name, list(zip(texts, vectors)), text_fields, vector_field,
+                                              num_candidates or max_k * 2, source=["id"])
+
+    tables = []
+    for config in configs:
+        retrieved = []
+        for lexical, knn in candidates:
+            hits = fuse_results([lexical, knn], fusion=config['fusion'], weights=config['weights'], rrf_k=rrf_k, size=max_k)
+            retrieved.append([hit["_source"]["id"] for hit in hits])
+
+        table = compute_retrieval_metrics(retrieved, [mapping[q_id] for q_id in q_ids], ks)
+        table['config'] = config['name']
+        tables.append(table.reset_index())
+
+    return pd.concat(tables).set_index(['config', 'k'])
+
+
 #evaluate top hits
-def evaluate_top_hit(os_manager, os_query, dataset, index_name, top_k=5, model_id=None):
+def evaluate_top_hit(os_manager, os_query, dataset, index_name, top_k=5, model_id=None, batch_size=None):
+    if batch_size:
+        return evaluate_top_hit_batched(os_manager, os_query, dataset, index_name, top_k=top_k, model_id=model_id, batch_size=batch_size)
+
     queries = dataset["queries"]
     mapping = dataset["relevant_docs"]
     eval_results = []
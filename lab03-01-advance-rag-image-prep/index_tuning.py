@@ -0,0 +1,339 @@
+import time
+import copy
+import itertools
+import faiss
+import numpy as np
+import pandas as pd
+from sagemaker.utils import name_from_base
+from vector_profiles import VECTOR_PROFILES, apply_vector_profile, fit_byte_scale, quantize_vectors
+from opensearch_util import build_filtered_knn_query, build_post_filtered_knn_query
+
+
+# index body in the same layout as the notebooks / knowledge base indexes
+def make_index_body(dimension, m=16, ef_construction=512, ef_search=512, space_type="l2", engine="faiss",
+                    vector_field="vector_field", number_of_shards=2, properties=None, vector_profile="float32"):
+    vector_mapping = apply_vector_profile({
+        "type": "knn_vector",
+        "dimension": dimension,
+        "method": {
+            "name": "hnsw",
+            "engine": engine,
+            "space_type": space_type,
+            "parameters": {
+                "m": m,
+                "ef_construction": ef_construction
+            }
+        }
+    }, vector_profile)
+
+    return {
+        "settings": {
+            "index": {
+                "knn": True,
+                "number_of_shards": number_of_shards,
+                "knn.algo_param": {
+                    "ef_search": ef_search
+                },
+            }
+        },
+        "mappings": {
+            "properties": {
+                **copy.deepcopy(properties or {}),
+                vector_field: vector_mapping
+            }
+        }
+    }
+
+
+# split the embeddings of a sample corpus into indexed vectors and held-out queries
+def sample_vectors(docs, vector_field="vector_field", num_queries=100, sample_size=None, seed=0):
+    vectors = np.asarray([doc[vector_field] for doc in docs], dtype=np.float32)
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(vectors))
+    if sample_size:
+        order = order[:sample_size + num_queries]
+
+    queries = vectors[order[:num_queries]]
+    corpus = vectors[order[num_queries:]]
+    return corpus, queries
+
+
+def _prepare(vectors, space_type):
+    vectors = np.array(vectors, dtype=np.float32)
+    if space_type == "cosinesimil":
+        faiss.normalize_L2(vectors)
+    return vectors
+
+
+def _metric(space_type):
+    if space_type in ("cosinesimil", "innerproduct"):
+        return faiss.METRIC_INNER_PRODUCT
+    return faiss.METRIC_L2
+
+
+# ground truth neighbors with an exact flat index
+def exact_neighbors(corpus, queries, k=10, space_type="l2"):
+    corpus = _prepare(corpus, space_type)
+    queries = _prepare(queries, space_type)
+
+    if _metric(space_type) == faiss.METRIC_INNER_PRODUCT:
+        index = faiss.IndexFlatIP(corpus.shape[1])
+    else:
+        index = faiss.IndexFlatL2(corpus.shape[1])
+    index.add(corpus)
+
+    _, ids = index.search(queries, k)
+    return ids
+
+
+def recall_at_k(found_ids, exact_ids, k=10):
+    hits = [len(set(found[:k]) & set(exact[:k])) for found, exact in zip(found_ids, exact_ids)]
+    return sum(hits) / (len(exact_ids) * k)
+
+
+# native memory of the HNSW graph as documented for the k-NN plugin: 1.1 * (bytes * d + 8 * m) bytes per vector
+def estimate_memory_bytes(num_vectors, dimension, m, vector_profile="float32"):
+    bytes_per_dimension = VECTOR_PROFILES[vector_profile]["bytes_per_dimension"]
+    return int(1.1 * (bytes_per_dimension * dimension + 8 * m) * num_vectors)
+
+
+def _latency_stats(latencies):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "qps": float(len(latencies) / (latencies.sum() / 1000)) if latencies.sum() > 0 else 0.0,
+    }
+
+
+# in-process baseline: one faiss HNSW graph per (space_type, m, ef_construction), ef_search is a query time knob
+def faiss_trials(corpus, queries, exact_ids, k, space_type, m, ef_construction, ef_search_values):
+    corpus = _prepare(corpus, space_type)
+    queries = _prepare(queries, space_type)
+
+    index = faiss.IndexHNSWFlat(corpus.shape[1], m, _metric(space_type))
+    index.hnsw.efConstruction = ef_construction
+
+    t0 = time.perf_counter()
+    index.add(corpus)
+    build_s = time.perf_counter() - t0
+    memory_bytes = int(faiss.serialize_index(index).nbytes)
+
+    results = []
+    for ef_search in ef_search_values:
+        index.hnsw.efSearch = max(ef_search, k)
+
+        found_ids = []
+        latencies = []
+        for query in queries:
+            t0 = time.perf_counter()
+            _, ids = index.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - t0)
+            found_ids.append(ids[0])
+
+        results.append({
+            "backend": "faiss",
+            "space_type": space_type,
+            "m": m,
+            "ef_construction": ef_construction,
+            "ef_search": ef_search,
+            f"recall@{k}": recall_at_k(found_ids, exact_ids, k),
+            **_latency_stats(latencies),
+            "build_s": build_s,
+            "memory_bytes": memory_bytes,
+        })
+    return results
+
+
+# cluster trial: a real index per grid point (ef_search is an index setting), removed afterwards
+def cluster_trial(os_manager, corpus, queries, exact_ids, k, space_type, m, ef_construction, ef_search,
+                  engine="faiss", vector_field="vector_field", index_prefix="hnsw-tuning", cleanup=True):
+    index_name = name_from_base(index_prefix)
+    body = make_index_body(corpus.shape[1], m, ef_construction, ef_search, space_type, engine, vector_field,
+                           properties={"doc_id": {"type": "integer"}})
+
+    os_manager.create_index(index_name=index_name, index_body=body)
+    os_manager.wait_for_index(index_name)
+    try:
+        t0 = time.perf_counter()
+        os_manager.stream_index_ingestion(index_name, ({"doc_id": i, vector_field: vector.tolist()} for i, vector in enumerate(corpus)))
+        os_manager.wait_for_documents(index_name, len(corpus))
+        build_s = time.perf_counter() - t0
+
+        found_ids = []
+        latencies = []
+        for query in queries:
+            search_body = {
+                "size": k,
+                "query": {"knn": {vector_field: {"vector": query.tolist(), "k": k}}},
+                "_source": ["doc_id"]
+            }
+            t0 = time.perf_counter()
+            hits = os_manager.opensearch_query(search_body, index_name=index_name)
+            latencies.append(time.perf_counter() - t0)
+            found_ids.append([hit["_source"]["doc_id"] for hit in hits])
+    finally:
+        if cleanup:
+            os_manager.remove_index(index_name)
+
+    return {
+        "backend": "cluster",
+        "space_type": space_type,
+        "m": m,
+        "ef_construction": ef_construction,
+        "ef_search": ef_search,
+        f"recall@{k}": recall_at_k(found_ids, exact_ids, k),
+        **_latency_stats(latencies),
+        "build_s": build_s,
+        "memory_bytes": estimate_memory_bytes(len(corpus), corpus.shape[1], m),
+    }
+
+
+def sweep(corpus, queries, k=10, m_values=(8, 16, 32), ef_construction_values=(128, 256, 512),
+          ef_search_values=(64, 128, 256, 512), space_types=("l2", "cosinesimil"), os_manager=None, **cluster_kwargs):
+    results = []
+    for space_type in space_types:
+        exact_ids = exact_neighbors(corpus, queries, k, space_type)
+
+        for m, ef_construction in itertools.product(m_values, ef_construction_values):
+            if os_manager is None:
+                trials = faiss_trials(corpus, queries, exact_ids, k, space_type, m, ef_construction, ef_search_values)
+            else:
+                trials = [
+                    cluster_trial(os_manager, corpus, queries, exact_ids, k, space_type, m, ef_construction, ef_search, **cluster_kwargs)
+                    for ef_search in ef_search_values
+                ]
+
+            for trial in trials:
+                print(f"{trial['backend']} {space_type} m={m} ef_construction={ef_construction} ef_search={trial['ef_search']}: "
+                      f"recall@{k} {trial[f'recall@{k}']:.3f}, p50 {trial['p50_ms']:.2f}ms, p95 {trial['p95_ms']:.2f}ms")
+            results.extend(trials)
+
+    return pd.DataFrame(results)
+
+
+# cheapest configuration meeting the recall target: lowest p95 latency, then memory and build time
+def recommend(results, dimension, k=10, min_recall=0.95, space_type=None, **index_kwargs):
+    candidates = results
+    if space_type is not None:
+        candidates = candidates[candidates["space_type"] == space_type]
+
+    passing = candidates[candidates[f"recall@{k}"] >= min_recall]
+    if len(passing) == 0:
+        print(f"No configuration reaches recall@{k} >= {min_recall}, using the highest recall")
+        passing = candidates[candidates[f"recall@{k}"] == candidates[f"recall@{k}"].max()]
+
+    best = passing.sort_values(["p95_ms", "memory_bytes", "build_s"]).iloc[0]
+    body = make_index_body(dimension, int(best["m"]), int(best["ef_construction"]), int(best["ef_search"]),
+                           best["space_type"], **index_kwargs)
+    return best.to_dict(), body
+
+
+def _profile_hnsw_index(dimension, m, space_type, vector_profile):
+    metric = _metric(space_type)
+    if vector_profile == "fp16":
+        return faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_fp16, m, metric)
+    if vector_profile == "byte":
+        return faiss.IndexHNSWSQ(dimension, faiss.ScalarQuantizer.QT_8bit_direct_signed, m, metric)
+    return faiss.IndexHNSWFlat(dimension, m, metric)
+
+
+# recall and memory of each storage profile against exact float32 search, with the same HNSW parameters
+def compare_vector_profiles(corpus, queries, k=10, space_type="l2", m=16, ef_construction=512, ef_search=512,
+                            profiles=("float32", "fp16", "byte"), byte_scale=None):
+    corpus = _prepare(corpus, space_type)
+    queries = _prepare(queries, space_type)
+    exact_ids = exact_neighbors(corpus, queries, k, space_type)
+
+    if byte_scale is None:
+        byte_scale = fit_byte_scale(corpus)
+
+    results = []
+    for vector_profile in profiles:
+        # the vectors are quantized the same way the helpers do before indexing and querying
+        profile_corpus = np.asarray(quantize_vectors(corpus, vector_profile, byte_scale), dtype=np.float32)
+        profile_queries = np.asarray(quantize_vectors(queries, vector_profile, byte_scale), dtype=np.float32)
+
+        index = _profile_hnsw_index(corpus.shape[1], m, space_type, vector_profile)
+        index.hnsw.efConstruction = ef_construction
+        if vector_profile != "float32":
+            index.train(profile_corpus)
+        index.add(profile_corpus)
+        index.hnsw.efSearch = max(ef_search, k)
+
+        found_ids = []
+        latencies = []
+        for query in profile_queries:
+            t0 = time.perf_counter()
+            _, ids = index.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - t0)
+            found_ids.append(ids[0])
+
+        results.append({
+            "vector_profile": vector_profile,
+            f"recall@{k}": recall_at_k(found_ids, exact_ids, k),
+            **_latency_stats(latencies),
+            "memory_bytes": int(faiss.serialize_index(index).nbytes),
+            "estimated_memory_bytes": estimate_memory_bytes(len(corpus), corpus.shape[1], m, vector_profile),
+        })
+
+    results = pd.DataFrame(results).set_index("vector_profile")
+    if "float32" in results.index:
+        results["memory_ratio"] = results["memory_bytes"] / results.loc["float32", "memory_bytes"]
+        results["recall_delta"] = results[f"recall@{k}"] - results.loc["float32", f"recall@{k}"]
+    return results
+
+
+# efficient k-NN filtering against post-filtering on a scratch index. every document gets a uniform
+# "bucket" value in [0, 1), so the range filter bucket < s matches a fraction s of the corpus
+def benchmark_filtered_knn(os_manager, corpus, queries, k=10, selectivities=(0.5, 0.1, 0.01, 0.001), space_type="l2",
+                           vector_field="vector_field", index_prefix="filtered-knn", cleanup=True, seed=0, **index_kwargs):
+    index_name = name_from_base(index_prefix)
+    body = make_index_body(corpus.shape[1], space_type=space_type, vector_field=vector_field,
+                           properties={"doc_id": {"type": "integer"}, "bucket": {"type": "float"}}, **index_kwargs)
+    buckets = np.random.default_rng(seed).random(len(corpus))
+
+    results = []
+    os_manager.create_index(index_name=index_name, index_body=body)
+    try:
+        os_manager.wait_for_index(index_name)
+        os_manager.stream_index_ingestion(index_name, (
+            {"doc_id": i, "bucket": float(bucket), vector_field: vector.tolist()}
+            for i, (vector, bucket) in enumerate(zip(corpus, buckets))
+        ))
+        os_manager.wait_for_documents(index_name, len(corpus))
+
+        for selectivity in selectivities:
+            allowed = np.flatnonzero(buckets < selectivity)
+            if len(allowed) == 0:
+                continue
+            k_eff = min(k, len(allowed))
+            exact_ids = allowed[exact_neighbors(corpus[allowed], queries, k_eff, space_type)]
+            search_filter = {"range": {"bucket": {"lt": selectivity}}}
+
+            for mode, build_query in [("efficient", build_filtered_knn_query), ("post", build_post_filtered_knn_query)]:
+                found_ids = []
+                latencies = []
+                for query in queries:
+                    search_body = build_query(query.tolist(), search_filter, k, vector_field)
+                    t0 = time.perf_counter()
+                    hits = os_manager.opensearch_query(search_body, index_name=index_name, source=["doc_id"])
+                    latencies.append(time.perf_counter() - t0)
+                    found_ids.append([hit["_source"]["doc_id"] for hit in hits])
+
+                results.append({
+                    "selectivity": selectivity,
+                    "matching_docs": len(allowed),
+                    "mode": mode,
+                    f"recall@{k}": recall_at_k(found_ids, exact_ids, k_eff),
+                    "avg_hits": float(np.mean([len(ids) for ids in found_ids])),
+                    **_latency_stats(latencies),
+                })
+                print(f"{mode} filtering, selectivity {selectivity}: recall@{k} {results[-1][f'recall@{k}']:.3f}, "
+                      f"{results[-1]['avg_hits']:.1f} hits, p50 {results[-1]['p50_ms']:.2f}ms")
+    finally:
+        if cleanup:
+            os_manager.remove_index(index_name)
+
+    return pd.DataFrame(results)
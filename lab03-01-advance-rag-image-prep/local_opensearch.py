@@ -0,0 +1,638 @@
+import os
+import re
+import json
+import math
+import copy
+import time
+import uuid
+import threading
+import faiss
+import numpy as np
+from opensearchpy import NotFoundError, RequestError
+
+
+# score translation of the k-NN plugin for each space type, from the raw distance / similarity
+def translate_score(space_type, engine, raw):
+    if space_type == "cosinesimil":
+        if engine == "lucene":
+            return (1 + raw) / 2
+        return 1 / (1 + (1 - raw))
+    if space_type == "innerproduct":
+        return np.where(raw >= 0, raw + 1, 1 / (1 - raw))
+    # l2 on squared euclidean distance
+    return 1 / (1 + raw)
+
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+# close to the standard analyzer: lowercased word tokens
+def analyze(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+class LocalIndex:
+    def __init__(self, name, body=None):
+        self.name = name
+        if isinstance(body, str):
+            body = json.loads(body)
+        self.body = copy.deepcopy(body or {})
+        self.ids = []
+        self.docs = []
+        self.positions = {}
+        self.vector_fields = {}
+        self._search_indexes = {}
+
+        properties = self.body.get("mappings", {}).get("properties", {})
+        for field, mapping in properties.items():
+            if mapping.get("type") == "knn_vector":
+                method = mapping.get("method", {})
+                self.vector_fields[field] = {
+                    "dimension": mapping["dimension"],
+                    "data_type": mapping.get("data_type", "float"),
+                    "space_type": method.get("space_type", mapping.get("space_type", "l2")),
+                    "engine": method.get("engine", "nmslib"),
+                }
+
+    def index_doc(self, source, doc_id=None):
+        for field, vector_field in self.vector_fields.items():
+            if field in source and len(source[field]) != vector_field["dimension"]:
+                raise RequestError(400, "mapper_parsing_exception",
+                                   f"Vector dimension mismatch. Expected: {vector_field['dimension']}, Given: {len(source[field])}")
+            if field in source and vector_field["data_type"] == "byte" and any(
+                    int(value) != value or not -128 <= value <= 127 for value in source[field]):
+                raise RequestError(400, "mapper_parsing_exception",
+                                   f"[{field}] only supports integers between -128 and 127 for byte vectors")
+
+        if doc_id is None:
+            doc_id = uuid.uuid4().hex
+        doc_id = str(doc_id)
+
+        if doc_id in self.positions:
+            self.docs[self.positions[doc_id]] = source
+            result = "updated"
+        else:
+            self.positions[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+            self.docs.append(source)
+            result = "created"
+
+        self._search_indexes = {}
+        return doc_id, result
+
+    def delete_doc(self, doc_id):
+        position = self.positions.pop(str(doc_id))
+        del self.ids[position]
+        del self.docs[position]
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._search_indexes = {}
+
+    def vectors(self, field):
+        dimension = self.vector_fields[field]["dimension"]
+        matrix = np.zeros((len(self.docs), dimension), dtype=np.float32)
+        present = np.zeros(len(self.docs), dtype=bool)
+        for i, doc in enumerate(self.docs):
+            if doc.get(field) is not None:
+                matrix[i] = doc[field]
+                present[i] = True
+        return matrix, present
+
+    # exact (flat) faiss index per vector field, rebuilt lazily after writes
+    def search_index(self, field):
+        if field not in self._search_indexes:
+            vector_field = self.vector_fields[field]
+            matrix, present = self.vectors(field)
+            if vector_field["space_type"] == "cosinesimil":
+                faiss.normalize_L2(matrix)
+            if vector_field["space_type"] in ("cosinesimil", "innerproduct"):
+                index = faiss.IndexFlatIP(vector_field["dimension"])
+            else:
+                index = faiss.IndexFlatL2(vector_field["dimension"])
+            index.add(matrix)
+            self._search_indexes[field] = (index, present)
+        return self._search_indexes[field]
+
+    # allowed restricts the search to the documents matching a filter, like the efficient k-NN filter
+    def knn(self, field, vector, k, allowed=None):
+        if field not in self.vector_fields:
+            raise RequestError(400, "query_shard_exception", f"Field '{field}' is not knn_vector type.")
+        if len(self.docs) == 0:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+
+        vector_field = self.vector_fields[field]
+        index, present = self.search_index(field)
+
+        query = np.asarray([vector], dtype=np.float32)
+        if vector_field["space_type"] == "cosinesimil":
+            faiss.normalize_L2(query)
+
+        if allowed is not None:
+            candidates = np.flatnonzero(present & allowed)
+            if len(candidates) == 0:
+                return np.array([], dtype=np.int64), np.array([], dtype=np.float32)
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBatch(candidates.astype(np.int64)))
+            raw, positions = index.search(query, min(k, len(candidates)), params=params)
+            raw, positions = raw[0], positions[0]
+            keep = positions >= 0
+            raw, positions = raw[keep], positions[keep]
+        else:
+            # documents without the vector field are over-fetched and dropped
+            num_missing = int((~present).sum())
+            raw, positions = index.search(query, min(k + num_missing, len(self.docs)))
+            raw, positions = raw[0], positions[0]
+            keep = (positions >= 0) & present[np.maximum(positions, 0)]
+            raw, positions = raw[keep][:k], positions[keep][:k]
+
+        scores = translate_score(vector_field["space_type"], vector_field["engine"], raw)
+        return positions, np.asarray(scores, dtype=np.float32)
+
+    # numeric column of a field for vectorized range filters, None when the field holds anything but numbers
+    def numeric_column(self, field):
+        key = ("numeric", field)
+        if key not in self._search_indexes:
+            values = [doc.get(field) for doc in self.docs]
+            numeric = all(value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)) for value in values)
+            self._search_indexes[key] = np.array([np.nan if value is None else value for value in values], dtype=np.float64) if numeric else None
+        return self._search_indexes[key]
+
+    def filter_mask(self, query):
+        (query_type, spec), = query.items()
+
+        if query_type == "bool" and set(spec) <= {"must", "filter", "must_not"}:
+            mask = np.ones(len(self.docs), dtype=bool)
+            for name in ("must", "filter", "must_not"):
+                clauses = spec.get(name, [])
+                for clause in (clauses if isinstance(clauses, list) else [clauses]):
+                    mask &= ~self.filter_mask(clause) if name == "must_not" else self.filter_mask(clause)
+            return mask
+
+        if query_type == "range":
+            (field, condition), = spec.items()
+            column = self.numeric_column(field)
+            if column is not None and all(op in ("gt", "gte", "lt", "lte") for op in condition):
+                # comparisons with nan (missing values) are false
+                mask = np.ones(len(self.docs), dtype=bool)
+                with np.errstate(invalid="ignore"):
+                    for op, bound in condition.items():
+                        mask &= {"gt": np.greater, "gte": np.greater_equal, "lt": np.less, "lte": np.less_equal}[op](column, bound)
+                return mask
+
+        return np.array([matches(doc_id, doc, query) for doc_id, doc in zip(self.ids, self.docs)], dtype=bool)
+
+    # per field postings for BM25, rebuilt lazily after writes like the vector indexes
+    def text_stats(self, field):
+        key = ("text", field)
+        if key not in self._search_indexes:
+            postings = {}
+            lengths = np.zeros(len(self.docs), dtype=np.float32)
+            for position, doc in enumerate(self.docs):
+                value = doc.get(field)
+                if value is None:
+                    continue
+                tokens = analyze(" ".join(value) if isinstance(value, list) else value)
+                lengths[position] = len(tokens)
+                counts = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                for token, count in counts.items():
+                    postings.setdefault(token, ([], []))
+                    postings[token][0].append(position)
+                    postings[token][1].append(count)
+
+            postings = {
+                token: (np.asarray(positions, dtype=np.int64), np.asarray(counts, dtype=np.float32))
+                for token, (positions, counts) in postings.items()
+            }
+            num_docs = int((lengths > 0).sum())
+            avg_length = float(lengths.sum() / num_docs) if num_docs else 0.0
+            self._search_indexes[key] = (postings, lengths, num_docs, avg_length)
+        return self._search_indexes[key]
+
+    # Lucene BM25 similarity (k1=1.2, b=0.75) over one text field
+    def bm25(self, field, text, k1=1.2, b=0.75):
+        postings, lengths, num_docs, avg_length = self.text_stats(field)
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        if num_docs == 0:
+            return scores
+
+        for token in set(analyze(text)):
+            if token not in postings:
+                continue
+            positions, counts = postings[token]
+            idf = math.log(1 + (num_docs - len(positions) + 0.5) / (len(positions) + 0.5))
+            norm = k1 * (1 - b + b * lengths[positions] / avg_length)
+            scores[positions] += idf * counts / (counts + norm)
+        return scores
+
+    def match(self, fields, text):
+        # best_fields: the score of the best matching field, with optional field^boost
+        scores = np.zeros(len(self.docs), dtype=np.float32)
+        for field in fields:
+            field, _, boost = field.partition("^")
+            scores = np.maximum(scores, self.bm25(field, text) * float(boost or 1))
+
+        positions = np.flatnonzero(scores > 0)
+        positions = positions[np.argsort(-scores[positions], kind="stable")]
+        return positions, scores[positions]
+
+    def save(self, directory):
+        matrices = {}
+        docs = []
+        for field in self.vector_fields:
+            matrices[field], _ = self.vectors(field)
+        for doc in self.docs:
+            docs.append({key: value for key, value in doc.items() if key not in self.vector_fields})
+        presence = {field: [field in doc for doc in self.docs] for field in self.vector_fields}
+
+        with open(os.path.join(directory, f"{self.name}.json"), "w", encoding="utf-8") as f:
+            json.dump({"body": self.body, "ids": self.ids, "docs": docs, "presence": presence}, f)
+        np.savez(os.path.join(directory, f"{self.name}.npz"), **matrices)
+
+    @classmethod
+    def load(cls, directory, name):
+        with open(os.path.join(directory, f"{name}.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        index = cls(name, data["body"])
+        matrices = np.load(os.path.join(directory, f"{name}.npz"))
+
+        for i, (doc_id, doc) in enumerate(zip(data["ids"], data["docs"])):
+            for field in index.vector_fields:
+                if data["presence"][field][i]:
+                    doc[field] = matrices[field][i].tolist()
+            index.positions[doc_id] = i
+            index.ids.append(doc_id)
+            index.docs.append(doc)
+        return index
+
+
+class LocalIndicesClient:
+    def __init__(self, client):
+        self.client = client
+
+    def create(self, index, body=None, **kwargs):
+        with self.client.lock:
+            if index in self.client.indexes:
+                raise RequestError(400, "resource_already_exists_exception", f"index [{index}] already exists")
+            if index in self.client.aliases:
+                raise RequestError(400, "invalid_index_name_exception", f"[{index}] already exists as alias")
+            self.client.indexes[index] = LocalIndex(index, body)
+            self.client.persist(index)
+        return {"acknowledged": True, "shards_acknowledged": True, "index": index}
+
+    def get(self, index, **kwargs):
+        local_index = self.client.get_index(index)
+        return {
+            local_index.name: {
+                "aliases": {alias: {} for alias, names in self.client.aliases.items() if local_index.name in names},
+                "mappings": local_index.body.get("mappings", {}),
+                "settings": local_index.body.get("settings", {}),
+            }
+        }
+
+    def exists(self, index, **kwargs):
+        return index in self.client.indexes or index in self.client.aliases
+
+    def delete(self, index, **kwargs):
+        with self.client.lock:
+            if index not in self.client.indexes:
+                raise NotFoundError(404, "index_not_found_exception", f"no such index [{index}]")
+            del self.client.indexes[index]
+            self.client.remove_persisted(index)
+            self.client.drop_from_aliases(index)
+        return {"acknowledged": True}
+
+    def get_alias(self, index=None, name=None, **kwargs):
+        names = [index] if index else list(self.client.indexes)
+        response = {}
+        for index_name in names:
+            if index_name not in self.client.indexes:
+                continue
+            aliases = {alias: {} for alias, indexes in self.client.aliases.items()
+                       if index_name in indexes and (name is None or alias == name)}
+            if aliases or name is None:
+                response[index_name] = {"aliases": aliases}
+        if name is not None and not response:
+            raise NotFoundError(404, "aliases_not_found_exception", f"alias [{name}] missing")
+        return response
+
+    def exists_alias(self, name, **kwargs):
+        return name in self.client.aliases
+
+    # all actions are applied under the lock, a search sees the aliases before or after the request, never in between
+    def update_aliases(self, body, **kwargs):
+        if isinstance(body, str):
+            body = json.loads(body)
+
+        with self.client.lock:
+            aliases = {alias: list(indexes) for alias, indexes in self.client.aliases.items()}
+            removed_indexes = []
+            for action in body["actions"]:
+                (action_type, spec), = action.items()
+                index = spec["index"]
+                if index not in self.client.indexes:
+                    raise NotFoundError(404, "index_not_found_exception", f"no such index [{index}]")
+                if action_type == "add":
+                    alias = spec["alias"]
+                    if alias in self.client.indexes and alias not in removed_indexes:
+                        raise RequestError(400, "invalid_alias_name_exception", f"an index exists with the same name as the alias [{alias}]")
+                    aliases.setdefault(alias, [])
+                    if index not in aliases[alias]:
+                        aliases[alias].append(index)
+                elif action_type == "remove":
+                    alias = spec["alias"]
+                    if index not in aliases.get(alias, []):
+                        raise NotFoundError(404, "aliases_not_found_exception", f"alias [{alias}] missing")
+                    aliases[alias].remove(index)
+                    if not aliases[alias]:
+                        del aliases[alias]
+                elif action_type == "remove_index":
+                    removed_indexes.append(index)
+                else:
+                    raise RequestError(400, "parsing_exception", f"unsupported alias action [{action_type}] in the local store")
+
+            for index in removed_indexes:
+                del self.client.indexes[index]
+                self.client.remove_persisted(index)
+                for indexes in aliases.values():
+                    if index in indexes:
+                        indexes.remove(index)
+            self.client.aliases = {alias: indexes for alias, indexes in aliases.items() if indexes}
+            self.client.persist_aliases()
+        return {"acknowledged": True}
+
+    def get_settings(self, index, **kwargs):
+        local_index = self.client.get_index(index)
+        return {local_index.name: {"settings": {"index": copy.deepcopy(local_index.body.get("settings", {}).get("index", {}))}}}
+
+    # null values reset a setting, refresh_interval and replicas have no effect on the local store
+    def put_settings(self, body, index, **kwargs):
+        if isinstance(body, str):
+            body = json.loads(body)
+        with self.client.lock:
+            local_index = self.client.get_index(index)
+            settings = local_index.body.setdefault("settings", {}).setdefault("index", {})
+            for key, value in body.get("index", body).items():
+                if value is None:
+                    settings.pop(key, None)
+                else:
+                    settings[key] = value
+            self.client.persist(local_index.name)
+        return {"acknowledged": True}
+
+    def forcemerge(self, index=None, **kwargs):
+        for name in ([index] if index else list(self.client.indexes)):
+            self.client.get_index(name)
+        return {"_shards": {"failed": 0}}
+
+    # writes are persisted on refresh rather than on every bulk request
+    def refresh(self, index=None, **kwargs):
+        with self.client.lock:
+            for name in ([index] if index else list(self.client.indexes)):
+                self.client.persist(self.client.get_index(name).name)
+        return {"_shards": {"failed": 0}}
+
+
+class LocalSerializer:
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        return json.dumps(data)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class LocalTransport:
+    def __init__(self):
+        self.serializer = LocalSerializer()
+
+
+# in-process stand-in for the opensearch-py client, covering the calls OpenSearchManager makes
+class LocalOpenSearchClient:
+    def __init__(self, persist_dir=None):
+        self.persist_dir = persist_dir
+        self.indexes = {}
+        self.aliases = {}
+        self.lock = threading.RLock()
+        self.indices = LocalIndicesClient(self)
+        self.transport = LocalTransport()
+
+        if persist_dir:
+            os.makedirs(persist_dir, exist_ok=True)
+            for file in sorted(os.listdir(persist_dir)):
+                # index names cannot start with an underscore, _aliases.json holds the aliases
+                if file.endswith(".json") and not file.startswith("_"):
+                    name = file[:-len(".json")]
+                    self.indexes[name] = LocalIndex.load(persist_dir, name)
+            aliases_file = os.path.join(persist_dir, "_aliases.json")
+            if os.path.exists(aliases_file):
+                with open(aliases_file, encoding="utf-8") as f:
+                    self.aliases = json.load(f)
+
+    def persist(self, index):
+        if self.persist_dir:
+            self.indexes[index].save(self.persist_dir)
+
+    def persist_aliases(self):
+        if self.persist_dir:
+            with open(os.path.join(self.persist_dir, "_aliases.json"), "w", encoding="utf-8") as f:
+                json.dump(self.aliases, f)
+
+    def drop_from_aliases(self, index):
+        aliases = {alias: [name for name in indexes if name != index] for alias, indexes in self.aliases.items()}
+        self.aliases = {alias: indexes for alias, indexes in aliases.items() if indexes}
+        self.persist_aliases()
+
+    def remove_persisted(self, index):
+        if self.persist_dir:
+            for ext in (".json", ".npz"):
+                file = os.path.join(self.persist_dir, f"{index}{ext}")
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def get_index(self, index):
+        # reads and writes through an alias go to its only index
+        if index in self.aliases:
+            if len(self.aliases[index]) != 1:
+                raise RequestError(400, "illegal_argument_exception", f"alias [{index}] has more than one index")
+            index = self.aliases[index][0]
+        if index not in self.indexes:
+            raise NotFoundError(404, "index_not_found_exception", f"no such index [{index}]")
+        return self.indexes[index]
+
+    def index(self, index, body, id=None, **kwargs):
+        with self.lock:
+            doc_id, result = self.get_index(index).index_doc(body, id)
+        return {"_index": index, "_id": doc_id, "result": result}
+
+    def bulk(self, body, index=None, **kwargs):
+        if isinstance(body, str):
+            lines = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            lines = list(body)
+
+        t0 = time.time()
+        items = []
+        with self.lock:
+            i = 0
+            while i < len(lines):
+                op, meta = next(iter(lines[i].items()))
+                index_name = meta.get("_index", index)
+                try:
+                    local_index = self.get_index(index_name)
+                    if op == "delete":
+                        local_index.delete_doc(meta["_id"])
+                        items.append({op: {"_index": index_name, "_id": meta["_id"], "status": 200, "result": "deleted"}})
+                        i += 1
+                    else:
+                        doc_id, result = local_index.index_doc(lines[i + 1], meta.get("_id"))
+                        items.append({op: {"_index": index_name, "_id": doc_id, "status": 201 if result == "created" else 200, "result": result}})
+                        i += 2
+                except Exception as e:
+                    status = getattr(e, "status_code", 500)
+                    if not isinstance(status, int):
+                        status = 500
+                    items.append({op: {"_index": index_name, "_id": meta.get("_id"), "status": status, "error": {"type": getattr(e, "error", type(e).__name__), "reason": str(getattr(e, "info", e))}}})
+                    i += 1 if op == "delete" else 2
+
+        return {
+            "took": int((time.time() - t0) * 1000),
+            "errors": any("error" in next(iter(item.values())) for item in items),
+            "items": items,
+        }
+
+    def search(self, body=None, index=None, **kwargs):
+        t0 = time.time()
+        body = body or {}
+        local_index = self.get_index(index)
+        size = body.get("size", 10)
+        query = body.get("query", {"match_all": {}})
+
+        if "knn" in query:
+            field, knn = next(iter(query["knn"].items()))
+            allowed = local_index.filter_mask(knn["filter"]) if "filter" in knn else None
+            positions, scores = local_index.knn(field, knn["vector"], knn.get("k", size), allowed)
+        elif "bool" in query and any("knn" in clause for clause in query["bool"].get("must", [])):
+            # knn inside a bool query: the top k neighbors are filtered afterwards (post-filtering)
+            must = query["bool"]["must"]
+            field, knn = next(iter(next(clause for clause in must if "knn" in clause)["knn"].items()))
+            positions, scores = local_index.knn(field, knn["vector"], knn.get("k", size))
+            rest = {"bool": {**query["bool"], "must": [clause for clause in must if "knn" not in clause]}}
+            keep = np.array([matches(local_index.ids[position], local_index.docs[position], rest) for position in positions.tolist()], dtype=bool)
+            positions, scores = positions[keep], scores[keep]
+        elif "bool" in query or "term" in query or "terms" in query or "range" in query or "exists" in query:
+            positions = np.flatnonzero(local_index.filter_mask(query))
+            scores = np.ones(len(positions), dtype=np.float32)
+        elif "match" in query:
+            field, match = next(iter(query["match"].items()))
+            text = match["query"] if isinstance(match, dict) else match
+            positions, scores = local_index.match([field], text)
+        elif "multi_match" in query:
+            positions, scores = local_index.match(query["multi_match"]["fields"], query["multi_match"]["query"])
+        elif "match_all" in query:
+            positions = np.arange(len(local_index.docs))
+            scores = np.ones(len(positions), dtype=np.float32)
+        elif "ids" in query:
+            positions = np.array([local_index.positions[doc_id] for doc_id in query["ids"]["values"] if doc_id in local_index.positions], dtype=np.int64)
+            scores = np.ones(len(positions), dtype=np.float32)
+        else:
+            raise RequestError(400, "parsing_exception", f"unsupported query {list(query)} in the local store")
+
+        total = len(positions)
+        positions, scores = positions[:size], scores[:size]
+
+        hits = []
+        for position, score in zip(positions.tolist(), scores.tolist()):
+            hit = {
+                "_index": local_index.name,
+                "_id": local_index.ids[position],
+                "_score": score,
+            }
+            # _source: false leaves the source out of the hit
+            if body.get("_source", True) is not False:
+                hit["_source"] = filter_source(local_index.docs[position], body.get("_source", True))
+            hits.append(hit)
+
+        return {
+            "took": int((time.time() - t0) * 1000),
+            "timed_out": False,
+            "hits": {
+                "total": {"value": total, "relation": "eq"},
+                "max_score": max(scores.tolist()) if len(scores) else None,
+                "hits": hits,
+            }
+        }
+
+    def msearch(self, body, index=None, **kwargs):
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+        responses = []
+        for header, search_body in zip(body[::2], body[1::2]):
+            try:
+                responses.append({**self.search(search_body, index=header.get("index", index)), "status": 200})
+            except Exception as e:
+                responses.append({"error": {"type": getattr(e, "error", type(e).__name__), "reason": str(e)}, "status": getattr(e, "status_code", 500)})
+        return {"responses": responses}
+
+
+# term, terms, range, exists, ids, match_all and bool (must / filter / should / must_not) on a single document
+def matches(doc_id, doc, query):
+    (query_type, spec), = query.items()
+
+    if query_type == "match_all":
+        return True
+    if query_type == "ids":
+        return doc_id in spec["values"]
+    if query_type == "exists":
+        return doc.get(spec["field"]) is not None
+    if query_type in ("term", "terms", "range"):
+        (field, condition), = spec.items()
+        value = doc.get(field)
+        values = value if isinstance(value, list) else [value]
+        if query_type == "term":
+            expected = condition["value"] if isinstance(condition, dict) else condition
+            return expected in values
+        if query_type == "terms":
+            return any(item in condition for item in values)
+        checks = {
+            "gt": lambda item, bound: item > bound,
+            "gte": lambda item, bound: item >= bound,
+            "lt": lambda item, bound: item < bound,
+            "lte": lambda item, bound: item <= bound,
+        }
+        return any(
+            item is not None and all(checks[op](item, bound) for op, bound in condition.items() if op in checks)
+            for item in values
+        )
+    if query_type == "bool":
+        def clauses(name):
+            value = spec.get(name, [])
+            return value if isinstance(value, list) else [value]
+        if not all(matches(doc_id, doc, clause) for clause in clauses("must") + clauses("filter")):
+            return False
+        if any(matches(doc_id, doc, clause) for clause in clauses("must_not")):
+            return False
+        should = clauses("should")
+        if should and not (clauses("must") or clauses("filter")) and not any(matches(doc_id, doc, clause) for clause in should):
+            return False
+        return True
+
+    raise RequestError(400, "parsing_exception", f"unsupported filter [{query_type}] in the local store")
+
+
+def filter_source(source, spec):
+    if spec is True or spec is None:
+        return copy.deepcopy(source)
+    if spec is False:
+        return None
+    if isinstance(spec, str):
+        spec = [spec]
+    if isinstance(spec, list):
+        return {key: copy.deepcopy(value) for key, value in source.items() if key in spec}
+    includes = spec.get("includes", spec.get("include"))
+    excludes = spec.get("excludes", spec.get("exclude", []))
+    return {
+        key: copy.deepcopy(value) for key, value in source.items()
+        if (not includes or key in includes) and key not in excludes
+    }
@@ -1,10 +1,59 @@
 import boto3
 import json
 import time
+import random
+import gzip
+import numpy as np
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from opensearchpy.helpers import bulk
-from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, TransportError, NotFoundError
+from opensearchpy.serializer import JSONSerializer
+from local_opensearch import LocalOpenSearchClient, LocalSerializer
 # from langchain_community.vectorstores import OpenSearchVectorSearch
 
+# JSON serializer writing floats with a fixed number of significant digits,
+# float32 embeddings otherwise go out with up to 17 digits per dimension (9 digits round trip a float32 exactly)
+class CompactJSONSerializer(JSONSerializer):
+    def __init__(self, float_precision=7):
+        self.float_precision = float_precision
+
+    def compact(self, data):
+        if isinstance(data, float):
+            return float(f"{data:.{self.float_precision}g}")
+        if isinstance(data, dict):
+            return {key: self.compact(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return [self.compact(value) for value in data]
+        if isinstance(data, np.ndarray):
+            return self.compact(data.tolist())
+        return data
+
+    def dumps(self, data):
+        # don't serialize strings
+        if isinstance(data, str):
+            return data
+        return super().dumps(self.compact(data))
+
+
+# poll a readiness probe with exponential backoff until it returns a truthy value, exceptions count as not ready
+def wait_until(probe, description, timeout=300, initial_interval=1, max_interval=15):
+    t0 = time.time()
+    interval = initial_interval
+    last_error = None
+    while True:
+        try:
+            result = probe()
+            if result:
+                print(f"{description} ready after {time.time() - t0:.1f}s")
+                return result
+        except Exception as ex:
+            last_error = ex
+        if time.time() - t0 + interval > timeout:
+            raise Exception(f"{description} not ready after {timeout}s, last error: {last_error}")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
 class OpenSearchManager:
     def __init__(self, region_name=None):
         self.boto_session = boto3.Session()
@@ -17,18 +66,30 @@ class OpenSearchManager:
         self.auth = AWSV4SignerAuth(self.credentials, self.region, self.service)
         self.client = None
         self.docsearch = None
+        self.pool_maxsize = 20
+        self._vector_fields = {}
+        # OpenSearch Serverless has no alias API, aliases are kept by the manager instead
+        self.supports_aliases = self.service != 'aoss'
+        self.index_pointers = {}
+        # refresh interval, replicas and segments are managed by OpenSearch Serverless
+        self.supports_index_settings = self.service != 'aoss'
 
-    def initialize_client(self, host=None):
+    # http_compress gzips request bodies and asks for gzipped responses,
+    # float_precision writes vectors with that many significant digits (None keeps the default serializer)
+    def initialize_client(self, host=None, http_compress=False, float_precision=None):
         if host is None and self.client is None:
             raise ValueError("Host URL is required to initialize the OpenSearch client.")
         elif host is not None:
+            serializer = JSONSerializer() if float_precision is None else CompactJSONSerializer(float_precision)
             self.client = OpenSearch(
                 hosts=[{'host': host, 'port': 443}],
                 http_auth=self.auth,
                 use_ssl=True,
                 verify_certs=True,
                 connection_class=RequestsHttpConnection,
-                pool_maxsize=20
+                pool_maxsize=self.pool_maxsize,
+                http_compress=http_compress,
+                serializer=serializer
             )
         # If self.client is already set, do nothing
 
@@ -68,10 +129,51 @@ class OpenSearchManager:
         
         
     
-    def bulk_index_ingestion(self, index_name, data):
+    # bulk-load profile for large ingests: refresh off and no replicas while writing, the previous
+    # settings are restored afterwards, followed by a refresh and an optional force merge
+    @contextmanager
+    def bulk_load_mode(self, index_name, no_replicas=True, force_merge=False, max_num_segments=None):
         if self.client is None:
             raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
 
+        if not self.supports_index_settings:
+            print(f"{index_name}: refresh and replicas are managed by the collection, bulk-load mode is skipped")
+            yield
+            return
+
+        response = self.client.indices.get_settings(index=index_name)
+        current = next(iter(response.values()))["settings"]["index"]
+
+        # None resets a setting that was not set explicitly to its default
+        bulk_settings = {"refresh_interval": "-1"}
+        restore_settings = {"refresh_interval": current.get("refresh_interval")}
+        if no_replicas:
+            bulk_settings["number_of_replicas"] = 0
+            restore_settings["number_of_replicas"] = current.get("number_of_replicas")
+
+        self.client.indices.put_settings(index=index_name, body={"index": bulk_settings})
+        print(f"{index_name}: bulk-load mode {bulk_settings}")
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.client.indices.put_settings(index=index_name, body={"index": restore_settings})
+            self.client.indices.refresh(index=index_name)
+            if force_merge:
+                if max_num_segments is None:
+                    self.client.indices.forcemerge(index=index_name)
+                else:
+                    self.client.indices.forcemerge(index=index_name, max_num_segments=max_num_segments)
+            print(f"{index_name}: settings restored {restore_settings} after {time.time() - t0:.2f}s")
+
+    def bulk_index_ingestion(self, index_name, data, bulk_load=False):
+        if self.client is None:
+            raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
+
+        if bulk_load:
+            with self.bulk_load_mode(index_name):
+                return self.bulk_index_ingestion(index_name, data)
+
         success, failed = bulk(
             self.client,
             data,
@@ -86,6 +188,126 @@ class OpenSearchManager:
 
         return success, failed
 
+    # streaming bulk ingestion: chunks by count and bytes, parallel requests, retries throttled (429) items
+    def stream_index_ingestion(self, index_name, docs, chunk_size=500, max_chunk_bytes=10 * 1024 * 1024,
+                               max_workers=None, max_retries=5, initial_backoff=1, max_backoff=60, bulk_load=False):
+        if self.client is None:
+            raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
+
+        if bulk_load:
+            with self.bulk_load_mode(index_name):
+                return self.stream_index_ingestion(index_name, docs, chunk_size=chunk_size, max_chunk_bytes=max_chunk_bytes,
+                                                   max_workers=max_workers, max_retries=max_retries,
+                                                   initial_backoff=initial_backoff, max_backoff=max_backoff)
+
+        # at most one request per pooled connection in flight, the iterator is only consumed as chunks complete
+        max_workers = min(max_workers or self.pool_maxsize, self.pool_maxsize)
+        serializer = self.client.transport.serializer
+
+        def to_lines(position, doc):
+            doc = dict(doc)
+            action = {'_index': index_name}
+            if '_id' in doc:
+                action['_id'] = doc.pop('_id')
+            return (position, serializer.dumps({'index': action}), serializer.dumps(doc))
+
+        def chunks():
+            chunk = []
+            chunk_bytes = 0
+            for position, doc in enumerate(docs):
+                item = to_lines(position, doc)
+                item_bytes = len(item[1].encode('utf-8')) + len(item[2].encode('utf-8')) + 2
+                if chunk and (len(chunk) >= chunk_size or chunk_bytes + item_bytes > max_chunk_bytes):
+                    yield chunk
+                    chunk = []
+                    chunk_bytes = 0
+                chunk.append(item)
+                chunk_bytes += item_bytes
+            if chunk:
+                yield chunk
+
+        def send(chunk):
+            success = 0
+            failed = []
+            retries = 0
+            attempt = 0
+            while chunk:
+                body = '\n'.join(line for _, action, source in chunk for line in (action, source)) + '\n'
+                throttled = []
+                try:
+                    response = self.client.bulk(body=body)
+                    for item, result in zip(chunk, response['items']):
+                        result = result.get('index', result)
+                        if result.get('status', 500) < 300:
+                            success += 1
+                        elif result['status'] == 429:
+                            throttled.append(item)
+                        else:
+                            failed.append({'position': item[0], 'status': result['status'], 'error': result.get('error')})
+                except TransportError as e:
+                    if e.status_code != 429:
+                        raise e
+                    throttled = chunk
+
+                if throttled and attempt >= max_retries:
+                    failed.extend({'position': item[0], 'status': 429, 'error': 'too many requests'} for item in throttled)
+                    break
+                if throttled:
+                    # exponential backoff with jitter before resending only the throttled items
+                    time.sleep(min(max_backoff, initial_backoff * (2 ** attempt)) * (0.5 + random.random() / 2))
+                    retries += len(throttled)
+                    attempt += 1
+                chunk = throttled
+            return success, failed, retries
+
+        success = 0
+        failed = []
+        retries = 0
+        t0 = time.time()
+
+        # future -> positions of the documents in the chunk
+        in_flight = {}
+
+        def collect(futures):
+            nonlocal success, retries
+            for future in futures:
+                positions = in_flight.pop(future)
+                try:
+                    chunk_success, chunk_failed, chunk_retries = future.result()
+                except Exception as ex:
+                    print(f"Bulk request failed: {ex}")
+                    chunk_success, chunk_retries = 0, 0
+                    chunk_failed = [{'position': position, 'status': getattr(ex, 'status_code', None), 'error': str(ex)} for position in positions]
+                success += chunk_success
+                failed.extend(chunk_failed)
+                retries += chunk_retries
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for chunk in chunks():
+                if len(in_flight) >= max_workers:
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(send, chunk)
+                in_flight[future] = [item[0] for item in chunk]
+
+            done, _ = wait(list(in_flight))
+            collect(done)
+
+        elapsed = time.time() - t0
+        docs_per_sec = success / elapsed if elapsed > 0 else 0
+
+        print(f"Indexed {success} documents in {elapsed:.2f}s ({docs_per_sec:.1f} docs/sec), {retries} throttled retries")
+        if len(failed) > 0:
+            print(f"Failed to index {len(failed)} documents")
+
+        return {
+            'success': success,
+            'failed': sorted(failed, key=lambda item: item['position']),
+            'retries': retries,
+            'elapsed': elapsed,
+            'docs_per_sec': docs_per_sec,
+        }
+
     def create_opensearch_collection(self, vector_store_name="", index_name="index", encryption_policy_name="ep", network_policy_name="np", access_policy_name="ap"):
         print(vector_store_name)
         security_policy = self.aoss_client.create_security_policy(
@@ -186,14 +408,390 @@ class OpenSearchManager:
             raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
     
         self.client.indices.delete(index=index_name)
+        self._vector_fields.pop(index_name, None)
         print(f"Deleted index: {index_name}")
     
+    # bulk ingestion with each client setting into a scratch index, bytes on the wire are measured on the
+    # serialized bulk body the same way the connection compresses it
+    def benchmark_wire_formats(self, host, index_name, index_body, docs, configs=None, **ingestion_kwargs):
+        if configs is None:
+            configs = [
+                {"http_compress": False, "float_precision": None},
+                {"http_compress": True, "float_precision": None},
+                {"http_compress": False, "float_precision": 7},
+                {"http_compress": True, "float_precision": 7},
+            ]
+
+        docs = list(docs)
+        client = self.client
+        # the local client is reused across configs, only its serializer changes
+        client_serializer = client.transport.serializer if client is not None else None
+        results = []
+        try:
+            for config in configs:
+                self.initialize_client(host, **config)
+                serializer = self.client.transport.serializer
+
+                body = "".join(
+                    serializer.dumps({"index": {"_index": index_name}}) + "\n" + serializer.dumps(doc) + "\n"
+                    for doc in docs
+                ).encode("utf-8")
+                wire_bytes = len(gzip.compress(body)) if config.get("http_compress") else len(body)
+
+                benchmark_index = f"{index_name}-{len(results)}"
+                self.create_index(benchmark_index, index_body)
+                try:
+                    ingestion = self.stream_index_ingestion(benchmark_index, docs, **ingestion_kwargs)
+                finally:
+                    self.remove_index(benchmark_index)
+
+                results.append({
+                    **config,
+                    "body_bytes": len(body),
+                    "wire_bytes": wire_bytes,
+                    "bytes_per_doc": wire_bytes / len(docs),
+                    "docs_per_sec": ingestion["docs_per_sec"],
+                    "failed": len(ingestion["failed"]),
+                })
+        finally:
+            self.client = client
+            if client is not None:
+                client.transport.serializer = client_serializer
+
+        baseline = results[0]["wire_bytes"]
+        for result in results:
+            result["wire_ratio"] = result["wire_bytes"] / baseline
+            print(f"http_compress={result['http_compress']} float_precision={result['float_precision']}: "
+                  f"{result['wire_bytes']:,} bytes ({result['wire_ratio']:.2f}x), {result['docs_per_sec']:.1f} docs/sec")
+        return results
+
+    # wait until a new index exists and answers searches
+    def wait_for_index(self, index_name, timeout=300):
+        def probe():
+            if not self.client.indices.exists(index=index_name):
+                return False
+            self.client.search(index=index_name, body={"size": 0, "query": {"match_all": {}}})
+            return True
+        return wait_until(probe, f"Index {index_name}", timeout=timeout)
+
+    # wait until at least num_docs documents are searchable, returns the count
+    def wait_for_documents(self, index_name, num_docs, timeout=300):
+        def probe():
+            response = self.client.search(index=index_name, body={"size": 0, "track_total_hits": True, "query": {"match_all": {}}})
+            count = response["hits"]["total"]["value"]
+            # wrapped so that a count of 0 is still a ready result when num_docs is 0
+            return [count] if count >= num_docs else None
+        return wait_until(probe, f"{num_docs} documents in {index_name}", timeout=timeout)[0]
+
+    # index that queries for an alias go to when the aliases are kept by the manager,
+    # these pointers live in memory and are lost with the manager
+    def resolve_index(self, index_name):
+        return self.index_pointers.get(index_name, index_name)
+
+    # indexes behind an alias, [] when the alias does not exist
+    def get_alias_indexes(self, alias):
+        if not self.supports_aliases:
+            return [self.index_pointers[alias]] if alias in self.index_pointers else []
+        try:
+            response = self.client.indices.get_alias(name=alias)
+        except NotFoundError:
+            return []
+        return sorted(response)
+
+    # point the alias at new_index in one _aliases request, a search sees either the old or the new index
+    # replace_index drops a concrete index that still has the alias name in the same request
+    def swap_alias(self, alias, new_index, replace_index=False):
+        old_indexes = self.get_alias_indexes(alias)
+        self._vector_fields.pop(alias, None)
+
+        if not self.supports_aliases:
+            self.index_pointers[alias] = new_index
+            print(f"{alias} -> {new_index} (kept by the manager, the collection has no aliases)")
+            return old_indexes
+
+        actions = [{"remove": {"index": index, "alias": alias}} for index in old_indexes if index != new_index]
+        if not old_indexes and self.client.indices.exists(index=alias):
+            if not replace_index:
+                raise ValueError(f"{alias} is an index, pass replace_index=True to replace it with the alias")
+            actions.append({"remove_index": {"index": alias}})
+        actions.append({"add": {"index": new_index, "alias": alias}})
+
+        self.client.indices.update_aliases(body={"actions": actions})
+        print(f"{alias} -> {new_index} (was {', '.join(old_indexes) or 'unset'})")
+        return old_indexes
+
+    # recall@k of a labelled sample: [(search body, relevant ids)], ids are read from id_field of the source
+    def sample_recall(self, index_name, recall_sample, k=10, id_field="id"):
+        bodies = [{**body, "size": k} for body, _ in recall_sample]
+        results = self.opensearch_msearch(bodies, index_name=index_name, source=[id_field])
+        recalls = []
+        for hits, (_, relevant_ids) in zip(results, recall_sample):
+            retrieved_ids = {hit["_source"][id_field] for hit in hits}
+            recalls.append(len(retrieved_ids & set(relevant_ids)) / max(len(relevant_ids), 1))
+        return sum(recalls) / max(len(recalls), 1)
+
+    # build a versioned index next to the live one, validate it and swap the alias, queries through
+    # the alias keep hitting the old index until the swap
+    # on AOSS the swap is only visible to this manager (index_pointers is in memory), other clients such as
+    # a Bedrock knowledge base keep using the previous index, which is therefore never deleted there
+    def reindex(self, alias, index_body, docs, expected_docs=None, recall_sample=None, min_recall=0.0, k=10,
+                id_field="id", replace_index=False, keep_old=True, **ingestion_kwargs):
+        if not self.supports_aliases and not keep_old:
+            raise ValueError("keep_old=False needs index aliases, on AOSS other clients still use the previous index")
+        if self.supports_aliases and not replace_index and not self.get_alias_indexes(alias) and self.client.indices.exists(index=alias):
+            raise ValueError(f"{alias} is an index, pass replace_index=True to replace it with the alias")
+
+        new_index = f"{alias}-v{int(time.time() * 1000)}"
+        if self.client.indices.exists(index=new_index):
+            raise ValueError(f"{new_index} already exists")
+        self.create_index(new_index, index_body)
+        self.wait_for_index(new_index)
+
+        try:
+            # nothing searches the new index before the swap, it is built in bulk-load mode
+            result = self.stream_index_ingestion(new_index, docs, **{"bulk_load": True, **ingestion_kwargs})
+            if len(result['failed']) > 0:
+                raise Exception(f"{len(result['failed'])} documents failed to index into {new_index}")
+
+            expected_docs = result['success'] if expected_docs is None else expected_docs
+            if result['success'] < expected_docs:
+                raise Exception(f"{new_index} has {result['success']} documents, expected {expected_docs}")
+            self.wait_for_documents(new_index, expected_docs)
+
+            recall = None
+            if recall_sample:
+                recall = self.sample_recall(new_index, recall_sample, k, id_field)
+                print(f"{new_index}: recall@{k} {recall:.3f} on {len(recall_sample)} sample queries")
+                if recall < min_recall:
+                    raise Exception(f"{new_index}: recall@{k} {recall:.3f} is below {min_recall}")
+
+            old_indexes = self.swap_alias(alias, new_index, replace_index)
+        except Exception as ex:
+            # the alias still points at the old index, only the new one is dropped
+            self.remove_index(new_index)
+            raise ex
+
+        if not keep_old:
+            for index in old_indexes:
+                self.remove_index(index)
+
+        return {
+            'index': new_index,
+            'previous': old_indexes,
+            'ingestion': result,
+            'recall': recall,
+        }
+
+    # kNN search restricted to the documents matching filter, see make_filter
+    def filtered_knn_search(self, index_name, vector, filter=None, k=10, vector_field="vector_field", **search_kwargs):
+        query = build_filtered_knn_query(vector, filter, k, vector_field)
+        return self.opensearch_query(query, index_name=index_name, **search_kwargs)
+
+    # knn_vector fields of an index, read from the mapping once
+    def get_vector_fields(self, index_name):
+        if index_name not in self._vector_fields:
+            try:
+                response = self.client.indices.get(index=index_name)
+            except Exception as ex:
+                print(ex)
+                return []
+            fields = set()
+            for index in response.values():
+                for field, mapping in index.get("mappings", {}).get("properties", {}).items():
+                    if mapping.get("type") == "knn_vector":
+                        fields.add(field)
+            self._vector_fields[index_name] = sorted(fields)
+        return self._vector_fields[index_name]
+
+    # _source of the search body: explicit includes/excludes, ids and scores only, or everything but the vectors
+    def apply_source_filter(self, query, index_name, source=None, ids_only=False, exclude_vectors=True):
+        query = dict(query)
+        if ids_only:
+            query["_source"] = False
+        elif source is not None:
+            query["_source"] = source
+        elif "_source" not in query and exclude_vectors:
+            vector_fields = self.get_vector_fields(index_name)
+            if vector_fields:
+                query["_source"] = {"excludes": vector_fields}
+        return query
+
     # embed and then search
-    def opensearch_query(self, query, index_name=""):
+    def opensearch_query(self, query, index_name="", source=None, ids_only=False, exclude_vectors=True):
         
         if self.client is None:
             raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
-        
+
+        index_name = self.resolve_index(index_name)
+        query = self.apply_source_filter(query, index_name, source, ids_only, exclude_vectors)
+        if ids_only:
+            # trim the response to ids and scores on the server
+            response = self.client.search(body=query, index=index_name, filter_path="hits.hits._id,hits.hits._score")
+            return response.get("hits", {}).get("hits", [])
+
         response = self.client.search(body=query, index=index_name)
     
-        return response["hits"]["hits"]
\ No newline at end of file
+        return response["hits"]["hits"]
+
+    # run many searches with _msearch, returns the hits of every query in order
+    def opensearch_msearch(self, queries, index_name="", batch_size=50, source=None, ids_only=False, exclude_vectors=True):
+
+        if self.client is None:
+            raise ValueError("OpenSearch client is not initialized. Call 'initialize_client' first.")
+
+        index_name = self.resolve_index(index_name)
+        results = []
+        for i in range(0, len(queries), batch_size):
+            body = []
+            for query in queries[i:i + batch_size]:
+                body.append({"index": index_name})
+                body.append(self.apply_source_filter(query, index_name, source, ids_only, exclude_vectors))
+
+            response = self.client.msearch(body=body)
+
+            for item in response["responses"]:
+                if "error" in item:
+                    raise Exception(f"msearch failed: {item['error']}")
+                results.append(item["hits"]["hits"])
+
+        return results
+
+    def build_hybrid_queries(self, text, vector, text_fields=("caption",), vector_field="vector_field", size=10, source=None):
+        text_fields = list(text_fields)
+        if len(text_fields) == 1:
+            lexical_query = {"match": {text_fields[0]: {"query": text}}}
+        else:
+            lexical_query = {"multi_match": {"query": text, "fields": text_fields}}
+
+        lexical = {"size": size, "query": lexical_query}
+        knn = {"size": size, "query": {"knn": {vector_field: {"vector": vector, "k": size}}}}
+        if source is not None:
+            lexical["_source"] = source
+            knn["_source"] = source
+        return lexical, knn
+
+    # lexical and knn candidates of every (text, vector) query, both searches go in the same _msearch
+    def hybrid_candidates(self, index_name, queries, text_fields=("caption",), vector_field="vector_field",
+                          num_candidates=10, source=None, batch_size=25):
+        bodies = []
+        for text, vector in queries:
+            bodies.extend(self.build_hybrid_queries(text, vector, text_fields, vector_field, num_candidates, source))
+
+        results = self.opensearch_msearch(bodies, index_name=index_name, batch_size=batch_size * 2)
+        return list(zip(results[0::2], results[1::2]))
+
+    def hybrid_msearch(self, index_name, queries, text_fields=("caption",), vector_field="vector_field", k=10,
+                       num_candidates=None, fusion="rrf", weights=(1.0, 1.0), rrf_k=60, source=None, batch_size=25):
+        candidates = self.hybrid_candidates(index_name, queries, text_fields, vector_field,
+                                            num_candidates or k * 2, source, batch_size)
+        return [
+            fuse_results([lexical, knn], fusion=fusion, weights=weights, rrf_k=rrf_k, size=k)
+            for lexical, knn in candidates
+        ]
+
+    # hybrid BM25 + kNN search fused on the client side
+    def hybrid_search(self, index_name, text, vector, text_fields=("caption",), vector_field="vector_field", k=10,
+                      num_candidates=None, fusion="rrf", weights=(1.0, 1.0), rrf_k=60, source=None):
+        return self.hybrid_msearch(index_name, [(text, vector)], text_fields, vector_field, k,
+                                   num_candidates, fusion, weights, rrf_k, source)[0]
+
+
+# bool filter from exact values and ranges, e.g. terms={"video": "a.mp4"}, ranges={"start": {"gt": 600}}
+def make_filter(terms=None, ranges=None):
+    clauses = []
+    for field, value in (terms or {}).items():
+        if isinstance(value, (list, tuple, set)):
+            clauses.append({"terms": {field: list(value)}})
+        else:
+            clauses.append({"term": {field: value}})
+    for field, condition in (ranges or {}).items():
+        clauses.append({"range": {field: condition}})
+    return {"bool": {"filter": clauses}} if clauses else None
+
+# the filter is applied while searching the graph (efficient k-NN filtering of the faiss and lucene engines),
+# k results come back whenever k documents match
+def build_filtered_knn_query(vector, filter=None, k=10, vector_field="vector_field"):
+    knn = {"vector": vector, "k": k}
+    if filter is not None:
+        knn["filter"] = filter
+    return {"size": k, "query": {"knn": {vector_field: knn}}}
+
+# post-filtering: the k nearest neighbors are found first and then filtered, selective filters return fewer than k
+def build_post_filtered_knn_query(vector, filter, k=10, vector_field="vector_field"):
+    return {"size": k, "query": {"bool": {"must": [{"knn": {vector_field: {"vector": vector, "k": k}}}], "filter": [filter]}}}
+
+
+# reciprocal rank fusion: sum of weight / (rrf_k + rank) over the result lists
+def rrf_fusion(result_lists, weights=None, rrf_k=60, size=10):
+    weights = weights or [1.0] * len(result_lists)
+    scores = {}
+    hits = {}
+    for weight, results in zip(weights, result_lists):
+        if weight == 0:
+            continue
+        for rank, hit in enumerate(results, start=1):
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + weight / (rrf_k + rank)
+            hits.setdefault(hit["_id"], hit)
+    return _fused_hits(scores, hits, size)
+
+
+# weighted sum of the min-max normalized scores of each result list
+def weighted_fusion(result_lists, weights=None, size=10):
+    weights = weights or [1.0 / len(result_lists)] * len(result_lists)
+    scores = {}
+    hits = {}
+    for weight, results in zip(weights, result_lists):
+        if weight == 0 or not results:
+            continue
+        values = [hit["_score"] for hit in results]
+        low, high = min(values), max(values)
+        for hit in results:
+            normalized = (hit["_score"] - low) / (high - low) if high > low else 1.0
+            scores[hit["_id"]] = scores.get(hit["_id"], 0.0) + weight * normalized
+            hits.setdefault(hit["_id"], hit)
+    return _fused_hits(scores, hits, size)
+
+
+def fuse_results(result_lists, fusion="rrf", weights=None, rrf_k=60, size=10):
+    if fusion == "rrf":
+        return rrf_fusion(result_lists, weights, rrf_k, size)
+    if fusion == "weighted":
+        return weighted_fusion(result_lists, weights, size)
+    raise ValueError(f"Unknown fusion {fusion}, use 'rrf' or 'weighted'")
+
+
+def _fused_hits(scores, hits, size):
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:size]
+    return [{**hits[doc_id], "_score": score} for doc_id, score in ranked]
+
+
+# same interface backed by an in-process store (faiss), for offline runs and local benchmarks
+class LocalOpenSearchManager(OpenSearchManager):
+    def __init__(self, persist_dir=None):
+        self.region = None
+        self.identity = None
+        self.aoss_client = None
+        self.docsearch = None
+        self.pool_maxsize = 4
+        self._vector_fields = {}
+        self.supports_aliases = True
+        self.index_pointers = {}
+        self.supports_index_settings = True
+        self.client = LocalOpenSearchClient(persist_dir=persist_dir)
+
+    def initialize_client(self, host=None, http_compress=False, float_precision=None):
+        # nothing to connect to, the local client is created with the manager, only the serializer applies
+        self.client.transport.serializer = LocalSerializer() if float_precision is None else CompactJSONSerializer(float_precision)
+
+    def create_opensearch_collection(self, vector_store_name="", **kwargs):
+        return "localhost"
+
+    def bulk_index_ingestion(self, index_name, data, bulk_load=False):
+        result = self.stream_index_ingestion(index_name, data, bulk_load=bulk_load)
+        return result['success'], result['failed']
+
+    def stream_index_ingestion(self, index_name, docs, **kwargs):
+        result = super().stream_index_ingestion(index_name, docs, **kwargs)
+        # persist the index when a persist_dir is set
+        self.client.indices.refresh(index=index_name)
+        return result
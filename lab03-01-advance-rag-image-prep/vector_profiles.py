@@ -0,0 +1,61 @@
+import copy
+import numpy as np
+
+# knn_vector storage profiles
+# fp16: faiss scalar quantization, vectors are sent as floats and stored in 2 bytes per dimension
+# byte: byte vectors, the client sends int8 values in [-128, 127] and the graph stores 1 byte per dimension
+VECTOR_PROFILES = {
+    "float32": {"bytes_per_dimension": 4, "encoder": None, "data_type": None},
+    "fp16": {"bytes_per_dimension": 2, "encoder": {"name": "sq", "parameters": {"type": "fp16"}}, "data_type": None},
+    "byte": {"bytes_per_dimension": 1, "encoder": None, "data_type": "byte"},
+}
+
+FP16_MAX = 65504.0
+
+
+def get_vector_profile(vector_profile):
+    if vector_profile not in VECTOR_PROFILES:
+        raise ValueError(f"Invalid vector profile. Your vector profile should be one of {list(VECTOR_PROFILES)}")
+    return VECTOR_PROFILES[vector_profile]
+
+
+# add the encoder / data_type of the profile to a knn_vector mapping
+def apply_vector_profile(vector_mapping, vector_profile="float32"):
+    profile = get_vector_profile(vector_profile)
+    vector_mapping = copy.deepcopy(vector_mapping)
+
+    if profile["data_type"]:
+        vector_mapping["data_type"] = profile["data_type"]
+    if profile["encoder"]:
+        if vector_mapping.get("method", {}).get("engine") != "faiss":
+            raise ValueError(f"The {vector_profile} profile requires the faiss engine")
+        vector_mapping["method"].setdefault("parameters", {})["encoder"] = copy.deepcopy(profile["encoder"])
+
+    return vector_mapping
+
+
+# byte vectors need one scale for the corpus and the queries, fitted on a sample of embeddings
+def fit_byte_scale(vectors, percentile=99.9):
+    max_abs = float(np.percentile(np.abs(np.asarray(vectors, dtype=np.float32)), percentile))
+    if max_abs == 0:
+        return 1.0
+    return 127.0 / max_abs
+
+
+# quantize vectors into the form the profile stores, returns lists ready for indexing / querying
+def quantize_vectors(vectors, vector_profile="float32", scale=None):
+    get_vector_profile(vector_profile)
+    vectors = np.asarray(vectors, dtype=np.float32)
+
+    if vector_profile == "fp16":
+        vectors = np.clip(vectors, -FP16_MAX, FP16_MAX).astype(np.float16).astype(np.float32)
+    elif vector_profile == "byte":
+        if scale is None:
+            raise ValueError("A scale is required for byte vectors, see fit_byte_scale")
+        vectors = np.clip(np.rint(vectors * scale), -128, 127).astype(np.int8).astype(np.int32)
+
+    return vectors.tolist()
+
+
+def quantize_vector(vector, vector_profile="float32", scale=None):
+    return quantize_vectors([vector], vector_profile, scale)[0]
@@ -1,20 +1,130 @@
 import json
 import boto3
 import json_repair
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from termcolor import colored
 from lib import frames
+from lib import chapters
+from lib import metrics
+from lib import bedrock_invoker
 
 MODEL_ID = 'anthropic.claude-3-haiku-20240307-v1:0'
 MODEL_VER = 'bedrock-2023-05-31'
 CLAUDE_PRICING = (0.00025, 0.00125)
 
 
-def analyze_conversations(transcript_file):
+def analyze_conversations(transcript_file, compact=False):
+    with metrics.stage('analyze_conversations'):
+        return _analyze_conversations(transcript_file, compact)
 
+## metrics stages are not thread safe, the callers open the stage and the concurrent windows only count into it
+def _analyze_conversations(transcript_file, compact=False):
+
+    messages, system, blocks = make_conversation_prompt(transcript_file, compact)
+
+    ## setting up the model params
+    model_params = {
+        'anthropic_version': MODEL_VER,
+        'max_tokens': 4096,
+        'temperature': 0.1,
+        'top_p': 0.7,
+        'top_k': 20,
+        'stop_sequences': ['\n\nHuman:'],
+        'system': system,
+        'messages': messages
+    }
+
+    response = inference(model_params)
+
+    ## chapters in seconds back to the exact block timestamps
+    if compact:
+        to_transcript_timestamps(response['content'][0]['json'].get('chapters', []), blocks)
+
+    return response
+
+## split the captions into overlapping time windows, each window covers the captions starting in [start_ms, end_ms)
+def make_transcript_windows(captions, window_ms=1800000, overlap_ms=120000):
+    if window_ms <= overlap_ms:
+        raise ValueError('window_ms must be larger than overlap_ms')
+
+    windows = []
+    if len(captions['start_ms']) == 0:
+        return windows
+
+    last_ms = int(captions['end_ms'].max())
+    start_ms = 0
+    while True:
+        end_ms = start_ms + window_ms
+        lo = int(np.searchsorted(captions['start_ms'], start_ms, side='left'))
+        hi = int(np.searchsorted(captions['start_ms'], end_ms, side='left'))
+        if hi > lo:
+            windows.append({
+                'start_ms': start_ms,
+                'end_ms': end_ms,
+                'captions': chapters.slice_captions(captions, lo, hi),
+            })
+        if end_ms >= last_ms:
+            break
+        start_ms = end_ms - overlap_ms
+
+    return windows
+
+## map-reduce: analyze overlapping windows concurrently, then merge the chapters into one list
+def analyze_conversations_windowed(transcript_file, window_ms=1800000, overlap_ms=120000, max_workers=4, compact=False):
+    captions = chapters.parse_webvtt_arrays(transcript_file)
+    windows = make_transcript_windows(captions, window_ms, overlap_ms)
+    if not windows:
+        raise Exception(f"no captions in {transcript_file}")
+
+    with metrics.stage('analyze_conversations'):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            responses = list(executor.map(
+                lambda window: _analyze_conversations(window['captions'], compact),
+                windows
+            ))
+
+    chapter_list = []
+    for i, (window, response) in enumerate(zip(windows, responses)):
+        # each window owns its range up to the middle of the overlaps, chapters are kept by their midpoint
+        own_start = window['start_ms'] + overlap_ms // 2 if i > 0 else 0
+        own_end = window['end_ms'] - overlap_ms // 2 if i < len(windows) - 1 else float('inf')
+
+        for chapter in response['content'][0]['json'].get('chapters', []):
+            start_ms = chapters.to_milliseconds(chapter['start'])
+            end_ms = chapters.to_milliseconds(chapter['end'])
+            if own_start <= (start_ms + end_ms) // 2 < own_end:
+                chapter_list.append(chapter)
+
+    # chapters that run across the window boundaries are merged
+    if chapter_list:
+        chapter_list = chapters.merge_chapters(chapter_list)
+
+    usage = {
+        'input_tokens': sum(response['usage']['input_tokens'] for response in responses),
+        'output_tokens': sum(response['usage']['output_tokens'] for response in responses),
+    }
+
+    return {
+        'usage': usage,
+        'windows': len(windows),
+        'content': [{
+            'type': 'text',
+            'json': {
+                'chapters': chapter_list
+            }
+        }]
+    }
+
+def make_conversation_prompt(transcript_file, compact=False):
     messages = []
+    blocks = None
 
     # transcript
-    transcript_message = make_transcript(transcript_file)
+    if compact:
+        transcript_message, blocks = make_compact_transcript(transcript_file)
+    else:
+        transcript_message = make_transcript(transcript_file)
     messages.append(transcript_message)
 
     # output format?
@@ -24,7 +134,7 @@ def analyze_conversations(transcript_file):
     })
 
     # example output
-    example_message = make_conversation_example()
+    example_message = make_conversation_example(compact)
     messages.append(example_message)
 
     # prefill output
@@ -34,26 +144,10 @@ def analyze_conversations(transcript_file):
     })
 
     ## system prompt to role play
-    system = 'You are a media operation assistant who analyses movie transcripts in WebVTT format and suggest chapter points based on the topic changes in the conversations. It is important to read the entire transcripts.'
-
-    ## setting up the model params
-    model_params = {
-        'anthropic_version': MODEL_VER,
-        'max_tokens': 4096,
-        'temperature': 0.1,
-        'top_p': 0.7,
-        'top_k': 20,
-        'stop_sequences': ['\n\nHuman:'],
-        'system': system,
-        'messages': messages
-    }
+    transcript_format = 'a compact format' if compact else 'WebVTT format'
+    system = f'You are a media operation assistant who analyses movie transcripts in {transcript_format} and suggest chapter points based on the topic changes in the conversations. It is important to read the entire transcripts.'
 
-    try:
-        response = inference(model_params)
-    except Exception as e:
-        print(colored(f"ERR: inference: {str(e)}\n RETRY...", 'red'))
-        response = inference(model_params)
-    return response
+    return messages, system, blocks
 
 def get_contextual_information(images, text):
     task_all = 'You are asked to provide the following information: a detail description to describe the scene, sentiment, and brands and logos that may appear in the scene, and five most relevant tags from the scene.'
@@ -115,30 +209,24 @@ def get_contextual_information(images, text):
         'messages': messages
     }
 
-    try:
-        response = inference(model_params)
-    except Exception as e:
-        print(colored(f"ERR: inference: {str(e)}\n RETRY...", 'red'))
+    with metrics.stage('contextual_information'):
         response = inference(model_params)
 
     return response
 
+# throttling is retried with backoff by bedrock_invoker, other errors are raised
 def inference(model_params):
-    model_id = MODEL_ID
-    accept = 'application/json'
-    content_type = 'application/json'
+    response_body = bedrock_invoker.invoke_model(MODEL_ID, model_params)
 
-    bedrock_runtime_client = boto3.client(service_name='bedrock-runtime')
-
-    response = bedrock_runtime_client.invoke_model(
-        body=json.dumps(model_params),
-        modelId=model_id,
-        accept=accept,
-        contentType=content_type
+    usage = response_body['usage']
+    input_per_1k, output_per_1k = CLAUDE_PRICING
+    metrics.count(
+        api_calls=1,
+        input_tokens=usage['input_tokens'],
+        output_tokens=usage['output_tokens'],
+        estimated_cost=(input_per_1k * usage['input_tokens'] + output_per_1k * usage['output_tokens']) / 1000
     )
 
-    response_body = json.loads(response.get('body').read())
-
     # patch the json string output with '{' and parse it
     response_content = response_body['content'][0]['text']
     if response_content[0] != '{':
@@ -159,6 +247,57 @@ def inference(model_params):
 
     return response_body
 
+# metadata filter of the knowledge base retrieve API on the chapter documents (video, start and end in seconds),
+# the vector store applies it during the kNN search so k matching chapters come back
+def make_moment_filter(video=None, start_after=None, start_before=None, end_after=None, end_before=None):
+    conditions = []
+    if isinstance(video, (list, tuple, set)):
+        conditions.append({'in': {'key': 'video', 'value': list(video)}})
+    elif video is not None:
+        conditions.append({'equals': {'key': 'video', 'value': video}})
+
+    for key, operator, value in [
+        ('start', 'greaterThan', start_after),
+        ('start', 'lessThan', start_before),
+        ('end', 'greaterThan', end_after),
+        ('end', 'lessThan', end_before),
+    ]:
+        if value is not None:
+            conditions.append({operator: {'key': key, 'value': value}})
+
+    if len(conditions) == 0:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'andAll': conditions}
+
+def retrieve_moments(knowledge_base_id, query, k=5, video=None, start_after=None, start_before=None, end_after=None, end_before=None):
+    bedrock_agent_runtime_client = boto3.client(service_name='bedrock-agent-runtime')
+
+    vector_search_configuration = {'numberOfResults': k}
+    moment_filter = make_moment_filter(video, start_after, start_before, end_after, end_before)
+    if moment_filter is not None:
+        vector_search_configuration['filter'] = moment_filter
+
+    response = bedrock_agent_runtime_client.retrieve(
+        knowledgeBaseId=knowledge_base_id,
+        retrievalQuery={'text': query},
+        retrievalConfiguration={'vectorSearchConfiguration': vector_search_configuration}
+    )
+    metrics.count(api_calls=1)
+
+    moments = []
+    for result in response['retrievalResults']:
+        metadata = result.get('metadata', {})
+        moments.append({
+            'video': metadata.get('video'),
+            'start': metadata.get('start'),
+            'end': metadata.get('end'),
+            'score': result.get('score'),
+            'text': result['content']['text'],
+        })
+    return moments
+
 def display_conversation_cost(response, display=True):
     # us-east-1 pricing
     input_per_1k, output_per_1k = CLAUDE_PRICING
@@ -211,12 +350,12 @@ def display_contextual_cost(usage, display=True):
         'estimated_cost': contextual_cost,
     }
 
-def make_conversation_example():
+def make_conversation_example(compact=False):
     example = {
         'chapters': [
             {
-                'start': '00:00:10.000',
-                'end': '00:00:32.000',
+                'start': 10 if compact else '00:00:10.000',
+                'end': 32 if compact else '00:00:32.000',
                 'reason': 'It appears the chapter talks about...'
             }
         ]
@@ -227,21 +366,114 @@ def make_conversation_example():
         'content': 'JSON format. An example of the output:\n{0}\n'.format(json.dumps(example))
     }
 
+# transcript_file can also be caption arrays (see chapters.parse_webvtt_arrays)
 def make_transcript(transcript_file):
-    with open(transcript_file, encoding="utf-8") as f:
-        transcript = f.read()
+    if isinstance(transcript_file, dict):
+        transcript = chapters.to_webvtt(transcript_file)
+    else:
+        with open(transcript_file, encoding="utf-8") as f:
+            transcript = f.read()
     
     return {
         'role': 'user',
         'content': 'Here is the transcripts in <transcript> tag:\n<transcript>{0}\n</transcript>\n'.format(transcript)
     }
 
+## merged cues, one line per block prefixed with its start offset in seconds
+def make_compact_transcript(transcript_file, max_gap_ms=1000, max_block_ms=30000):
+    captions = transcript_file
+    if not isinstance(captions, dict):
+        captions = chapters.parse_webvtt_arrays(transcript_file)
+    blocks = chapters.merge_cues(captions, max_gap_ms, max_block_ms)
+
+    lines = [
+        f"[{start_ms // 1000}] {text}"
+        for start_ms, text in zip(blocks['start_ms'].tolist(), blocks['text'])
+    ]
+    if len(blocks['end_ms']):
+        lines.append(f"[{int(blocks['end_ms'][-1]) // 1000}] (end)")
+
+    legend = 'Each line starts with [N], the number of seconds from the start of the video, and lasts until the next line. Use these numbers of seconds for the chapter start and end.'
+    transcript = '\n'.join(lines)
+
+    return {
+        'role': 'user',
+        'content': '{0}\nHere is the transcripts in <transcript> tag:\n<transcript>\n{1}\n</transcript>\n'.format(legend, transcript)
+    }, blocks
+
+## map chapter start/end seconds to the nearest block start/end in milliseconds
+def to_transcript_timestamps(chapter_list, blocks):
+    starts = blocks['start_ms']
+    ends = blocks['end_ms']
+    if len(starts) == 0:
+        return chapter_list
+
+    # seconds as asked in the legend, or HH:MM:SS(.mmm) when the model ignores it
+    def to_ms(value):
+        try:
+            return float(value) * 1000
+        except (TypeError, ValueError):
+            pass
+        try:
+            value = str(value).strip()
+            return chapters.to_milliseconds(value if '.' in value else f"{value}.000")
+        except ValueError:
+            return None
+
+    def nearest(values, ms):
+        idx = int(np.searchsorted(values, ms))
+        candidates = [i for i in (idx - 1, idx) if 0 <= i < len(values)]
+        return int(values[min(candidates, key=lambda i: abs(values[i] - ms))])
+
+    for chapter in chapter_list:
+        start, end = to_ms(chapter['start']), to_ms(chapter['end'])
+        if start is None or end is None:
+            print(colored(f"Unrecognized chapter timestamps {chapter['start']} - {chapter['end']}, kept as is", 'red'))
+            continue
+        start_ms = nearest(starts, start)
+        end_ms = max(nearest(ends, end), start_ms)
+        chapter['start'] = chapters.to_hhmmssms(start_ms)
+        chapter['end'] = chapters.to_hhmmssms(end_ms)
+
+    return chapter_list
+
+def count_input_tokens(messages, system):
+    # a single output token, the usage reports the exact input tokens of the prompt
+    response_body = bedrock_invoker.invoke_model(MODEL_ID, {
+        'anthropic_version': MODEL_VER,
+        'max_tokens': 1,
+        'system': system,
+        'messages': messages,
+    })
+    return response_body['usage']['input_tokens']
+
+## measure the prompt size of the raw WebVTT vs the compact transcript
+def compare_transcript_encodings(transcript_files, count_tokens=True, display=True):
+    input_per_1k, _ = CLAUDE_PRICING
+
+    results = []
+    for transcript_file in transcript_files:
+        result = {'transcript_file': transcript_file}
+        for name, compact in [('raw', False), ('compact', True)]:
+            messages, system, _ = make_conversation_prompt(transcript_file, compact)
+            result[f"{name}_chars"] = len(system) + sum(len(message['content']) for message in messages)
+            if count_tokens:
+                result[f"{name}_tokens"] = count_input_tokens(messages, system)
+
+        unit = 'tokens' if count_tokens else 'chars'
+        result['savings'] = round(1 - result[f"compact_{unit}"] / result[f"raw_{unit}"], 4)
+        if count_tokens:
+            result['saved_cost'] = (result['raw_tokens'] - result['compact_tokens']) * input_per_1k / 1000
+        results.append(result)
+
+        if display:
+            print(f"{transcript_file}: {result[f'raw_{unit}']} -> {result[f'compact_{unit}']} {unit}", colored(f"({round(result['savings'] * 100, 1)}% smaller)", 'green'))
+
+    return results
+
 def make_image_message(images):
-    # adding the composite image sequences
-    image_contents = [{
-        'type': 'text',
-        'text': 'Here are {0} images containing frame sequence that describes a scene.'.format(len(images))
-    }]
+    # adding the composite image sequences, PIL images or encoded JPEG bytes (can be a generator)
+    image_contents = []
 
     for image in images:
         bas64_image = frames.image_to_base64(image)
@@ -254,6 +486,11 @@ def make_image_message(images):
             }
         })
 
+    image_contents.insert(0, {
+        'type': 'text',
+        'text': 'Here are {0} images containing frame sequence that describes a scene.'.format(len(image_contents))
+    })
+
     return {
         'role': 'user',
         'content': image_contents
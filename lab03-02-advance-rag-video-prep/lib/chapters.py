@@ -1,8 +1,14 @@
+import re
 import math
+import bisect
 import webvtt
+import numpy as np
+from array import array
 from functools import cmp_to_key
 import json
 
+CUE_TIMING_PATTERN = re.compile(r'^((?:\d+:)?\d{2}:\d{2}\.\d{3})\s+-->\s+((?:\d+:)?\d{2}:\d{2}\.\d{3})(.*)$')
+
 
 
 def to_milliseconds(timestamp):
@@ -30,6 +36,140 @@ def parse_webvtt(file):
 
     return captions
 
+def cue_timestamp_to_milliseconds(timestamp):
+    # WebVTT allows the hour to be omitted
+    if timestamp.count(':') == 1:
+        timestamp = f"00:{timestamp}"
+    return to_milliseconds(timestamp)
+
+## streaming parser, yields (start_ms, end_ms, text) one cue at a time
+def iter_webvtt(file):
+    with open(file, encoding='utf-8-sig') as f:
+        cue = None
+        for line in f:
+            line = line.rstrip('\r\n')
+
+            if cue is not None:
+                if line.strip():
+                    cue[2].append(line)
+                    continue
+                yield cue[0], cue[1], '\n'.join(cue[2]).strip()
+                cue = None
+                continue
+
+            # header, cue identifiers, NOTE and STYLE blocks are skipped until the next cue timing line
+            match = CUE_TIMING_PATTERN.match(line)
+            if match:
+                cue = (cue_timestamp_to_milliseconds(match.group(1)), cue_timestamp_to_milliseconds(match.group(2)), [])
+
+        if cue is not None:
+            yield cue[0], cue[1], '\n'.join(cue[2]).strip()
+
+## struct of arrays: int64 start_ms / end_ms and a list of texts
+def parse_webvtt_arrays(file):
+    start_ms = array('q')
+    end_ms = array('q')
+    text = []
+
+    for cue_start, cue_end, cue_text in iter_webvtt(file):
+        start_ms.append(cue_start)
+        end_ms.append(cue_end)
+        text.append(cue_text)
+
+    return {
+        'start_ms': np.frombuffer(start_ms, dtype=np.int64),
+        'end_ms': np.frombuffer(end_ms, dtype=np.int64),
+        'text': text,
+    }
+
+def to_caption_arrays(captions):
+    if isinstance(captions, dict):
+        return captions
+    return {
+        'start_ms': np.array([caption['start_ms'] for caption in captions], dtype=np.int64),
+        'end_ms': np.array([caption['end_ms'] for caption in captions], dtype=np.int64),
+        'text': [caption['text'] for caption in captions],
+    }
+
+## merge consecutive cues into blocks, a new block starts after a pause or once the block gets too long
+def merge_cues(captions, max_gap_ms = 1000, max_block_ms = 30000):
+    starts = captions['start_ms']
+    ends = captions['end_ms']
+    texts = captions['text']
+
+    blocks = {
+        'start_ms': [],
+        'end_ms': [],
+        'text': [],
+    }
+    for i in range(len(starts)):
+        if blocks['start_ms'] and starts[i] - blocks['end_ms'][-1] <= max_gap_ms and ends[i] - blocks['start_ms'][-1] <= max_block_ms:
+            blocks['end_ms'][-1] = max(blocks['end_ms'][-1], int(ends[i]))
+            blocks['text'][-1] += ' ' + texts[i].replace('\n', ' ')
+            continue
+        blocks['start_ms'].append(int(starts[i]))
+        blocks['end_ms'].append(int(ends[i]))
+        blocks['text'].append(texts[i].replace('\n', ' '))
+
+    blocks['start_ms'] = np.array(blocks['start_ms'], dtype=np.int64)
+    blocks['end_ms'] = np.array(blocks['end_ms'], dtype=np.int64)
+    return blocks
+
+def slice_captions(captions, lo, hi):
+    return {
+        'start_ms': captions['start_ms'][lo:hi],
+        'end_ms': captions['end_ms'][lo:hi],
+        'text': captions['text'][lo:hi],
+    }
+
+def to_webvtt(captions):
+    cues = ['WEBVTT', '']
+    for start_ms, end_ms, text in zip(captions['start_ms'].tolist(), captions['end_ms'].tolist(), captions['text']):
+        cues.append(f"{to_hhmmssms(start_ms)} --> {to_hhmmssms(end_ms)}")
+        cues.append(text)
+        cues.append('')
+    return '\n'.join(cues)
+
+## index range [lo, hi) of the captions that overlap [start_ms, end_ms), cues are in time order
+def captions_in_range(captions, start_ms, end_ms):
+    lo = int(np.searchsorted(captions['end_ms'], start_ms, side='right'))
+    hi = int(np.searchsorted(captions['start_ms'], end_ms, side='left'))
+    return lo, max(lo, hi)
+
+## map a timestamp of the silence-trimmed audio back to the source video timeline
+def to_source_ms(milliseconds, offset_map, is_end = False, starts = None):
+    if starts is None:
+        starts = [segment['start_ms'] for segment in offset_map]
+
+    # an end timestamp that falls on a cut belongs to the segment before the cut
+    if is_end:
+        idx = bisect.bisect_left(starts, milliseconds) - 1
+    else:
+        idx = bisect.bisect_right(starts, milliseconds) - 1
+    idx = min(max(idx, 0), len(offset_map) - 1)
+
+    segment = offset_map[idx]
+    return segment['source_start_ms'] + (milliseconds - segment['start_ms'])
+
+def remap_webvtt(file, offset_map, output_file):
+    starts = [segment['start_ms'] for segment in offset_map]
+
+    lines = []
+    with open(file, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            match = CUE_TIMING_PATTERN.match(line)
+            if match:
+                start_ms = to_source_ms(cue_timestamp_to_milliseconds(match.group(1)), offset_map, starts=starts)
+                end_ms = to_source_ms(cue_timestamp_to_milliseconds(match.group(2)), offset_map, is_end=True, starts=starts)
+                line = f"{to_hhmmssms(start_ms)} --> {to_hhmmssms(end_ms)}{match.group(3)}"
+            lines.append(line)
+
+    with open(output_file, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    return output_file
+
 # merge chapters just in case there are overlapped timestamps of the chapters
 # sort by start time and by end time
 def cmp_timestamps(a, b):
@@ -102,11 +242,14 @@ def merge_chapters(chapters):
         merged.pop()
         merged.append(new_chapter)
 
-    return chapters
+    return merged
 
 
 ## Validating the timestamp boundaries of the conversations against the WebVtt timestamps
 def validate_timestamps(chapters, captions):
+    if isinstance(captions, dict):
+        return validate_timestamps_arrays(chapters, captions)
+
     ## collect caption timestamps per chapter
     for chapter in chapters:
         chapter_start = chapter['start_ms']
@@ -155,4 +298,43 @@ def validate_timestamps(chapters, captions):
 
         del chapter['timestamps']
 
-    return chapters
\ No newline at end of file
+    return chapters
+
+## same alignment as validate_timestamps on caption arrays (see parse_webvtt_arrays), captions are not consumed
+def validate_timestamps_arrays(chapters, captions):
+    starts = captions['start_ms']
+    ends = captions['end_ms']
+
+    pos = 0
+    for chapter in chapters:
+        chapter_start = chapter['start_ms']
+        chapter_end = chapter['end_ms']
+
+        # captions starting at or after the chapter end are never taken
+        hi = max(pos, int(np.searchsorted(starts, chapter_end, side='left')))
+        cue_starts = starts[pos:hi]
+        cue_ends = ends[pos:hi]
+
+        # captions ending before the chapter starts are skipped, the first caption closer to the next chapter stops the scan
+        overlaps = cue_ends > chapter_start
+        stops = overlaps & (np.abs(chapter_end - cue_starts) < np.abs(cue_ends - chapter_end))
+        stop = int(np.argmax(stops)) if stops.any() else len(stops)
+
+        taken = np.flatnonzero(overlaps[:stop])
+        pos += stop
+
+        if len(taken) == 0:
+            continue
+
+        caption_start = int(cue_starts[taken[0]])
+        caption_end = int(cue_ends[taken[-1]])
+
+        if chapter_start != caption_start:
+            chapter['start_ms'] = caption_start
+            chapter['start'] = to_hhmmssms(caption_start)
+
+        if chapter_end != caption_end:
+            chapter['end_ms'] = caption_end
+            chapter['end'] = to_hhmmssms(caption_end)
+
+    return chapters
@@ -1,21 +1,22 @@
 import json
 import os
-import boto3
 import faiss
 from functools import cmp_to_key
 import numpy as np
 from numpy import dot
 from numpy.linalg import norm
-from PIL import Image
 from pathlib import Path
 from termcolor import colored
 from lib import frames
 from lib import util
+from lib import metrics
+from lib import frame_store
+from lib import bedrock_invoker
 
 TITAN_MODEL_ID = 'amazon.titan-embed-image-v1'
 TITAN_PRICING = 0.00006
 
-def batch_generate_embeddings(jpeg_files, output_dir = ''):
+def batch_generate_embeddings(jpeg_files, output_dir = '', frames_in_shots = None):
 
     output_file = os.path.join(output_dir, 'frame_embeddings.json')
     if os.path.exists(output_file):
@@ -26,56 +27,70 @@ def batch_generate_embeddings(jpeg_files, output_dir = ''):
     frame_embeddings = []
 
     titan_model_id = TITAN_MODEL_ID
-    accept = 'application/json'
-    content_type = 'application/json'
 
-    bedrock_runtime_client = boto3.client(service_name='bedrock-runtime')
-
-    for jpeg_file in jpeg_files:
-        with Image.open(jpeg_file) as image:
-            input_image = frames.image_to_base64(image)
-
-        model_params = {
-            'inputImage': input_image,
-            'embeddingConfig': {
-                'outputEmbeddingLength': 384 #1024 #384 #256
+    # with shots detected upfront, only the keyframes of each shot are embedded
+    # and the other frames reuse the embedding of the closest keyframe in the shot
+    keyframe_of = {}
+    if frames_in_shots is not None:
+        for frames_in_shot in frames_in_shots:
+            frame_ids = frames_in_shot['frame_ids']
+            keyframe_ids = frames_in_shot.get('keyframe_ids') or [frame_ids[len(frame_ids) // 2]]
+            for frame_id in frame_ids:
+                keyframe_of[frame_id] = min(keyframe_ids, key=lambda keyframe_id: abs(keyframe_id - frame_id))
+
+    keyframe_embeddings = {}
+    with metrics.stage('generate_embeddings', output_dir or None):
+        for jpeg_file in jpeg_files:
+            frame_no = int(Path(jpeg_file).stem.split('.')[1]) - 1
+            if keyframe_of.get(frame_no, frame_no) != frame_no:
+                continue
+
+            with frame_store.open_image(jpeg_file) as image:
+                input_image = frames.image_to_base64(image)
+
+            model_params = {
+                'inputImage': input_image,
+                'embeddingConfig': {
+                    'outputEmbeddingLength': 384 #1024 #384 #256
+                }
             }
-        }
 
-        body = json.dumps(model_params)
+            response_body = bedrock_invoker.invoke_model(titan_model_id, model_params)
+            metrics.count(api_calls=1, estimated_cost=TITAN_PRICING)
 
-        response = bedrock_runtime_client.invoke_model(
-            body=body,
-            modelId=titan_model_id,
-            accept=accept,
-            contentType=content_type
-        )
-        response_body = json.loads(response.get('body').read())
+            keyframe_embeddings[frame_no] = response_body['embedding']
 
+    for jpeg_file in jpeg_files:
         frame_no = int(Path(jpeg_file).stem.split('.')[1]) - 1
-        frame_embeddings.append({
+        keyframe_no = keyframe_of.get(frame_no, frame_no)
+        frame_embedding = {
             'file': jpeg_file,
             'frame_no': frame_no,
-            'embedding': response_body['embedding']
-        })
+            'embedding': keyframe_embeddings[keyframe_no]
+        }
+        if frames_in_shots is not None:
+            frame_embedding['keyframe'] = keyframe_no == frame_no
+        frame_embeddings.append(frame_embedding)
 
     util.save_to_file(output_file, frame_embeddings)
     return frame_embeddings
 
 def display_embedding_cost(frame_embeddings, display=True):
     per_image_embedding = TITAN_PRICING
-    estimated_cost = per_image_embedding * len(frame_embeddings)
+    # frames that reuse a keyframe embedding are not billed
+    num_embeddings = len([frame for frame in frame_embeddings if frame.get('keyframe', True)])
+    estimated_cost = per_image_embedding * num_embeddings
 
     if display:
         print('\n')
         print('========================================================================')
-        print('Estimated cost:', colored(f"${round(estimated_cost, 4)}", 'green'), f"in us-east-1 region with {len(frame_embeddings)} embeddings")
+        print('Estimated cost:', colored(f"${round(estimated_cost, 4)}", 'green'), f"in us-east-1 region with {num_embeddings} embeddings")
         print('========================================================================')
 
     return {
         'per_image_embedding': per_image_embedding,
         'estimated_cost': estimated_cost,
-        'num_embeddings': len(frame_embeddings)
+        'num_embeddings': num_embeddings
     }
 
 def create_index(dimension):
@@ -1,12 +1,15 @@
 import os
-import time
+import re
 import json
 import glob
+import shutil
 import subprocess
 import shlex
 from pathlib import Path
 from urllib.parse import urlparse
 from lib import util
+from lib import metrics
+from lib import frame_store
 
 def probe_stream(video_url):
     video = urlparse(video_url)
@@ -34,15 +37,16 @@ def probe_stream(video_url):
 
     command_string = f'ffprobe -v quiet -print_format json -show_format -show_streams {shlex.quote(video_url)}'
     
-    # shlex.quote will place harmful input in quotes so it can't be executed by the shell
-    # nosemgrep Rule ID: dangerous-subprocess-use-audit
-    child_process = subprocess.Popen(
-        shlex.split(command_string),
-        shell=False,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE
-    )
-    stdout, stderr = child_process.communicate()
+    with metrics.stage('probe_stream', video_dir):
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        child_process = subprocess.Popen(
+            shlex.split(command_string),
+            shell=False,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        stdout, stderr = child_process.communicate()
 
     stream_info = json.loads(str(stdout, 'utf-8'))
     stream_info['format']['filename'] = video_file
@@ -75,7 +79,7 @@ def probe_stream(video_url):
 
     return stream_info
 
-def extract_frames(video_url, stream_info, max_res = (750, 500)):
+def extract_frames(video_url, stream_info, max_res = (750, 500), keyframes_only = False, packed = False):
     video = urlparse(video_url)
     video_file = video.path
     video_dir = Path(video_file).stem
@@ -88,21 +92,20 @@ def extract_frames(video_url, stream_info, max_res = (750, 500)):
     if video.scheme == 'file' and not os.path.exists(video_file):
         raise Exception('input video does not exist')
 
-    frame_dir = os.path.join(video_dir, 'frames')
+    frame_dir = os.path.join(video_dir, 'keyframes' if keyframes_only else 'frames')
     if os.path.exists(frame_dir):
-        jpeg_frames = sorted(glob.glob(f"{frame_dir}/*.jpg"))
+        jpeg_frames = frame_store.list_frames(frame_dir)
         print(f"  extract_frames: found {len(jpeg_frames)} frames. SKIPPING...")
         return jpeg_frames
 
     util.mkdir(frame_dir)
 
-    t0 = time.time()
     video_filters = []
     video_stream = stream_info['video_stream']
 
     # need deinterlacing
     progressive = video_stream['progressive']
-    if not progressive:
+    if not progressive and not keyframes_only:
         video_filters.append('yadif')
 
     # downscale image
@@ -110,6 +113,17 @@ def extract_frames(video_url, stream_info, max_res = (750, 500)):
     factor = max((max_res[0] / dw), (max_res[1] / dh))
     w = round((dw * factor) / 2) * 2
     h = round((dh * factor) / 2) * 2
+
+    if keyframes_only:
+        # yadif needs the neighbouring frames, scale the fields instead
+        interlaced = '' if progressive else ':interl=1'
+        video_filters.append(f"scale={w}x{h}:flags=fast_bilinear{interlaced}")
+        print(f"  Resizing keyframes: {dw}x{dh} -> {w}x{h} (Progressive? {progressive})")
+        jpeg_frames = _extract_keyframes(video_url, video_dir, frame_dir, video_filters)
+        if packed:
+            jpeg_frames = frame_store.pack_frames(frame_dir)
+        return jpeg_frames
+
     video_filters.append(f"scale={w}x{h}")
 
     # ffmpeg -ss 588 -i f"{video_url}" -vf "yadif,scale=iw*sar:ih" -frames:v 1 test2.jpg
@@ -132,25 +146,90 @@ def extract_frames(video_url, stream_info, max_res = (750, 500)):
     print(f"  Resizing: {dw}x{dh} -> {w}x{h} (Progressive? {progressive})")
     print(f"  Command: {command}")
     
-    # shlex.quote will place harmful input in quotes so it can't be executed by the shell
-    # nosemgrep Rule ID: dangerous-subprocess-use-audit
-    subprocess.run(
-        command,
-        shell=False,
-        stdout=subprocess.DEVNULL,
-        # stderr=subprocess.DEVNULL
-    )
-
-    t1 = time.time()
-    print(f"  extract_frames: elapsed {round(t1 - t0, 2)}s")
+    with metrics.stage('extract_frames', video_dir) as stage:
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        subprocess.run(
+            command,
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            # stderr=subprocess.DEVNULL
+        )
+
+    print(f"  extract_frames: elapsed {round(stage['wall_s'], 2)}s")
+
+    # pack the loose jpeg files into a single archive
+    if packed:
+        return frame_store.pack_frames(frame_dir)
 
     # return jpeg files
     jpeg_frames = sorted(glob.glob(f"{frame_dir}/*.jpg"))
     return jpeg_frames
 
+def _extract_keyframes(video_url, video_dir, frame_dir, video_filters):
+    # decode I-frames only and log their presentation time with showinfo
+    command = [
+        'ffmpeg',
+        '-nostats',
+        '-skip_frame',
+        'nokey',
+        '-i',
+        shlex.quote(video_url),
+        '-vf',
+        f"{','.join(video_filters + ['showinfo'])}",
+        '-fps_mode',
+        'passthrough',
+        f"{shlex.quote(frame_dir)}/keyframe.%07d.jpg"
+    ]
+
+    print(f"  Command: {command}")
+
+    with metrics.stage('extract_keyframes', video_dir) as stage:
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        child_process = subprocess.run(
+            command,
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+    stderr = str(child_process.stderr, 'utf-8', errors='ignore')
+
+    pts_times = [
+        float(match.group(1))
+        for match in re.finditer(r'\[Parsed_showinfo[^\]]*\] n:\s*\d+ .*?pts_time:\s*(-?[\d.]+)', stderr)
+    ]
+    keyframes = sorted(glob.glob(f"{frame_dir}/keyframe.*.jpg"))
+
+    # the files are paired with the showinfo lines by position, any mismatch would misplace frames in time,
+    # a failed run is removed so the cache check of extract_frames does not return it as an empty result
+    error = None
+    if child_process.returncode != 0:
+        error = f"ffmpeg exited with code {child_process.returncode}"
+    elif not keyframes:
+        error = 'no keyframes extracted'
+    elif len(keyframes) != len(pts_times):
+        error = f"{len(keyframes)} keyframes written but {len(pts_times)} timestamps logged"
+    if error:
+        shutil.rmtree(frame_dir, ignore_errors=True)
+        raise Exception(f"extract_keyframes: {error}\n{stderr[-2000:]}")
+
+    # name the keyframes after the second they are presented at, using the same
+    # frames.%07d.jpg numbering as the 1fps extraction (frame N is second N - 1)
+    for keyframe, pts_time in zip(keyframes, pts_times):
+        frame_file = os.path.join(frame_dir, f"frames.{int(max(pts_time, 0)) + 1:07d}.jpg")
+        if os.path.exists(frame_file):
+            os.remove(keyframe)
+        else:
+            os.rename(keyframe, frame_file)
+
+    print(f"  extract_frames: {len(pts_times)} keyframes, elapsed {round(stage['wall_s'], 2)}s")
+
+    # return jpeg files
+    jpeg_frames = sorted(glob.glob(f"{frame_dir}/frames.*.jpg"))
+    return jpeg_frames
+
 def extract_audio(video_url):
-    t0 = time.time()
-    
     video = urlparse(video_url)
     video_file = video.path
     video_dir = Path(video_file).stem
@@ -192,18 +271,187 @@ def extract_audio(video_url):
     ]
     print(command)
     
+    with metrics.stage('extract_audio', video_dir) as stage:
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        subprocess.run(
+            command,
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    print(f"  extract_audio: elapsed {round(stage['wall_s'], 2)}s")
+    return wav_file
+
+# compressed audio formats accepted by Amazon Transcribe
+AUDIO_FORMATS = {
+    'flac': {
+        'extension': 'flac',
+        'media_format': 'flac',
+        'codec_args': ['-c:a', 'flac'],
+    },
+    'opus': {
+        'extension': 'ogg',
+        'media_format': 'ogg',
+        'codec_args': ['-c:a', 'libopus', '-b:a', '24k'],
+    },
+}
+
+def detect_silences(video_url, noise_db = -35, min_silence_ms = 2000):
+    # energy based voice activity detection with ffmpeg silencedetect
+    command = [
+        'ffmpeg',
+        '-nostats',
+        '-i',
+        shlex.quote(video_url),
+        '-vn',
+        '-af',
+        f"silencedetect=noise={noise_db}dB:d={min_silence_ms / 1000}",
+        '-f',
+        'null',
+        '-'
+    ]
+
     # shlex.quote will place harmful input in quotes so it can't be executed by the shell
     # nosemgrep Rule ID: dangerous-subprocess-use-audit
-    subprocess.run(
+    child_process = subprocess.run(
         command,
         shell=False,
         stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL
+        stderr=subprocess.PIPE
     )
+    stderr = str(child_process.stderr, 'utf-8', errors='ignore')
+
+    silences = []
+    silence_start = None
+    for line in stderr.splitlines():
+        match = re.search(r'silence_start: (-?[\d.]+)', line)
+        if match:
+            silence_start = max(float(match.group(1)), 0)
+            continue
+        match = re.search(r'silence_end: ([\d.]+)', line)
+        if match and silence_start is not None:
+            silences.append((round(silence_start * 1000), round(float(match.group(1)) * 1000)))
+            silence_start = None
+
+    # silence running until the end of the stream
+    if silence_start is not None:
+        silences.append((round(silence_start * 1000), None))
+
+    return silences
+
+def make_offset_map(silences, duration_ms, padding_ms = 250, step_ms = 10):
+    # keep a bit of padding around the speech and snap the cut points to the 10ms sample grid
+    # so the trimmed timeline can be mapped back to the source timeline exactly
+    def snap(ms):
+        return int(round(ms / step_ms)) * step_ms
+
+    duration_ms = snap(duration_ms)
+
+    cuts = []
+    for silence_start, silence_end in silences:
+        if silence_end is None:
+            silence_end = duration_ms + padding_ms
+        cut_start = snap(silence_start + padding_ms)
+        cut_end = snap(silence_end - padding_ms)
+        if cut_end > cut_start:
+            cuts.append((cut_start, min(cut_end, duration_ms)))
+
+    offset_map = []
+    position_ms = 0
+    trimmed_ms = 0
+    for cut_start, cut_end in cuts + [(duration_ms, duration_ms)]:
+        if cut_start > position_ms:
+            offset_map.append({
+                'start_ms': trimmed_ms,
+                'end_ms': trimmed_ms + (cut_start - position_ms),
+                'source_start_ms': position_ms,
+            })
+            trimmed_ms += cut_start - position_ms
+        position_ms = max(position_ms, cut_end)
+
+    return offset_map
+
+def prepare_audio(video_url, duration_ms, codec = 'flac', noise_db = -35, min_silence_ms = 2000, padding_ms = 250):
+    video = urlparse(video_url)
+    video_file = video.path
+    video_dir = Path(video_file).stem
 
-    t1 = time.time()
-    print(f"  extract_audio: elapsed {round(t1 - t0, 2)}s")
-    return wav_file
+    # input check: video is a file or https 
+    if video.scheme not in ['https', 'file', '']:
+        raise Exception('input video must be a local file path or use https')
+
+    # input check: file scheme video exists
+    if video.scheme == 'file' and not os.path.exists(video_file):
+        raise Exception('input video does not exist')
+
+    if codec not in AUDIO_FORMATS:
+        raise Exception(f"codec must be one of {list(AUDIO_FORMATS.keys())}")
+
+    audio_format = AUDIO_FORMATS[codec]
+    audio_file = os.path.join(video_dir, f"audio.{audio_format['extension']}")
+    offset_map_file = os.path.join(video_dir, 'audio_offsets.json')
+
+    # check to see if the audio file already exists
+    if os.path.exists(audio_file) and os.path.exists(offset_map_file):
+        with open(offset_map_file, 'r', encoding="utf-8") as f:
+            offset_map = json.loads(f.read())
+        print(f"  prepare_audio: found {Path(audio_file).name}. SKIPPING...")
+        return audio_file, offset_map
+
+    util.mkdir(video_dir)
+
+    with metrics.stage('prepare_audio', video_dir) as stage:
+        silences = detect_silences(video_url, noise_db, min_silence_ms)
+        offset_map = make_offset_map(silences, duration_ms, padding_ms)
+        if not offset_map:
+            raise Exception('prepare_audio: no audio left after removing silences')
+
+        # resample and split into 10ms frames (160 samples) so aselect cuts on the same grid as the offset map
+        segments = '+'.join([
+            f"gte(t,{segment['source_start_ms'] / 1000:.2f})*lt(t,{(segment['source_start_ms'] + segment['end_ms'] - segment['start_ms']) / 1000:.2f})"
+            for segment in offset_map
+        ])
+        audio_filters = [
+            'aresample=16000',
+            'asetnsamples=n=160:p=0',
+            f"aselect='{segments}'",
+            'asetpts=N/SR/TB',
+        ]
+
+        command = [
+            'ffmpeg',
+            '-v',
+            'quiet',
+            '-y',
+            '-i',
+            shlex.quote(video_url),
+            '-vn',
+            '-af',
+            ','.join(audio_filters),
+            '-ac',
+            str(1),
+            *audio_format['codec_args'],
+            audio_file
+        ]
+
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        subprocess.run(
+            command,
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    util.save_to_file(offset_map_file, offset_map)
+
+    trimmed_ms = offset_map[-1]['end_ms'] if offset_map else 0
+    print(f"  prepare_audio: kept {round(trimmed_ms / 1000, 2)}s of {round(duration_ms / 1000, 2)}s in {len(offset_map)} segments")
+    print(f"  prepare_audio: elapsed {round(stage['wall_s'], 2)}s")
+
+    return audio_file, offset_map
 
 def create_lowres_video(video_url, stream_info, max_res = (360, 202)):
     video = urlparse(video_url)
@@ -263,18 +511,16 @@ def create_lowres_video(video_url, stream_info, max_res = (360, 202)):
     print(f"  Downscaling: {dw}x{dh} -> {w}x{h} (Progressive? {progressive})")
     print(f"  Command: {command}")
 
-    t0 = time.time()
-    
-    # shlex.quote will place harmful input in quotes so it can't be executed by the shell
-    # nosemgrep Rule ID: dangerous-subprocess-use-audit
-    subprocess.run(
-        command,
-        shell=False,
-        stdout=subprocess.DEVNULL,
-        # stderr=subprocess.DEVNULL
-    )
-
-    t1 = time.time()
-    print(f"  downscale_video: elapsed {round(t1 - t0, 2)}s")
+    with metrics.stage('create_lowres_video', video_dir) as stage:
+        # shlex.quote will place harmful input in quotes so it can't be executed by the shell
+        # nosemgrep Rule ID: dangerous-subprocess-use-audit
+        subprocess.run(
+            command,
+            shell=False,
+            stdout=subprocess.DEVNULL,
+            # stderr=subprocess.DEVNULL
+        )
+
+    print(f"  downscale_video: elapsed {round(stage['wall_s'], 2)}s")
 
     return low_res_video_file
@@ -0,0 +1,112 @@
+import os
+import glob
+import json
+import mmap
+import threading
+from io import BytesIO
+from PIL import Image
+from lib import util
+
+PACK_FILE = 'frames.pack'
+INDEX_FILE = 'frames.index.json'
+
+_stores = {}
+_lock = threading.Lock()
+
+class FrameStore:
+    # concatenated JPEG frames in a single file with an offset index, read through a memory map
+    def __init__(self, frame_dir):
+        self.frame_dir = frame_dir
+
+        with open(os.path.join(frame_dir, INDEX_FILE), encoding="utf-8") as f:
+            frames = json.load(f)['frames']
+
+        self.names = [name for name, _, _ in frames]
+        self.index = {name: (offset, length) for name, offset, length in frames}
+
+        self._file = open(os.path.join(frame_dir, PACK_FILE), 'rb')
+        self._mmap = None
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return os.path.basename(name) in self.index
+
+    def files(self):
+        return [os.path.join(self.frame_dir, name) for name in self.names]
+
+    def read_bytes(self, name):
+        offset, length = self.index[os.path.basename(name)]
+        return self._mmap[offset:offset + length]
+
+    def open_image(self, name):
+        return Image.open(BytesIO(self.read_bytes(name)))
+
+    # random access by frame number, frame N is stored as frames.{N + 1}.jpg
+    def get_frame(self, frame_no):
+        return self.open_image(f"frames.{frame_no + 1:07d}.jpg")
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+        self._file.close()
+
+def is_packed(frame_dir):
+    return os.path.exists(os.path.join(frame_dir, INDEX_FILE))
+
+def pack_frames(frame_dir, remove = True):
+    jpeg_files = sorted(glob.glob(f"{frame_dir}/*.jpg"))
+
+    pack_file = os.path.join(frame_dir, PACK_FILE)
+    index_file = os.path.join(frame_dir, INDEX_FILE)
+
+    frames = []
+    offset = 0
+    with open(f"{pack_file}.tmp", 'wb') as f:
+        for jpeg_file in jpeg_files:
+            with open(jpeg_file, 'rb') as jpeg:
+                data = jpeg.read()
+            f.write(data)
+            frames.append([os.path.basename(jpeg_file), offset, len(data)])
+            offset += len(data)
+
+    # the index is written last so a partially written pack is never picked up
+    os.replace(f"{pack_file}.tmp", pack_file)
+    util.save_to_file(f"{index_file}.tmp", {'frames': frames})
+    os.replace(f"{index_file}.tmp", index_file)
+
+    if remove:
+        for jpeg_file in jpeg_files:
+            os.remove(jpeg_file)
+
+    with _lock:
+        store = _stores.pop(os.path.abspath(frame_dir), None)
+    if store is not None:
+        store.close()
+
+    return [os.path.join(frame_dir, name) for name, _, _ in frames]
+
+def get_store(frame_dir):
+    key = os.path.abspath(frame_dir)
+    with _lock:
+        if key not in _stores:
+            _stores[key] = FrameStore(frame_dir)
+        return _stores[key]
+
+def list_frames(frame_dir):
+    if is_packed(frame_dir):
+        return get_store(frame_dir).files()
+    return sorted(glob.glob(f"{frame_dir}/*.jpg"))
+
+# open a frame by its file path, from the pack when the frame directory has been packed
+def open_image(file):
+    frame_dir = os.path.dirname(file)
+    store = _stores.get(os.path.abspath(frame_dir))
+    if store is None and is_packed(frame_dir):
+        store = get_store(frame_dir)
+    if store is not None and file in store:
+        return store.open_image(file)
+    return Image.open(file)
@@ -7,12 +7,34 @@ from PIL import Image, ImageDraw
 from IPython.display import display
 from lib import util
 from lib import embeddings
+from lib import frame_store
+
+# Claude downscales images with a long edge above 1568px and rejects images above 5MB (base64 encoded)
+MAX_IMAGE_EDGE = 1568
+MAX_IMAGE_BYTES = 3750000
 
 def image_to_base64(image):
+    if isinstance(image, bytes):
+        return base64.b64encode(image).decode('utf8')
     buff = BytesIO()
     image.save(buff, format='JPEG')
     return base64.b64encode(buff.getvalue()).decode('utf8')
 
+def encode_jpeg(image, max_bytes = MAX_IMAGE_BYTES, quality = 85, min_quality = 45):
+    # lower the quality first, then the resolution, until the payload fits
+    while True:
+        buff = BytesIO()
+        image.save(buff, format='JPEG', quality=quality, optimize=True)
+        if buff.tell() <= max_bytes:
+            return buff.getvalue()
+
+        if quality > min_quality:
+            quality = max(quality - 10, min_quality)
+            continue
+
+        w, h = image.size
+        image = image.resize((int(w * 0.75), int(h * 0.75)))
+
 def skip_frames(frames, max_frames = 80):
     if len(frames) < max_frames:
         return frames
@@ -26,10 +48,10 @@ def skip_frames(frames, max_frames = 80):
     
     return output_frames
 
-def create_grid_image(image_files, max_ncol = 10, border_width = 2):
+def create_grid_image(image_files, max_ncol = 10, border_width = 2, max_edge = None):
     should_resize = len(image_files) > 50
 
-    with Image.open(image_files[0]) as image:
+    with frame_store.open_image(image_files[0]) as image:
         width, height = image.size
 
     ncol = max_ncol
@@ -39,6 +61,13 @@ def create_grid_image(image_files, max_ncol = 10, border_width = 2):
     nrow = len(image_files) // ncol
     if len(image_files) % ncol > 0:
         nrow += 1
+
+    # build the grid directly at the target size instead of downscaling it afterwards
+    if max_edge:
+        scale = max_edge / max(width * ncol, height * nrow)
+        if scale < 1:
+            width, height = int(width * scale), int(height * scale)
+            should_resize = True
     
     # Create a new image to hold the grid
     grid_width = width * ncol
@@ -48,8 +77,10 @@ def create_grid_image(image_files, max_ncol = 10, border_width = 2):
     draw = ImageDraw.Draw(grid_image)
     # Paste the individual images into the grid
     for i, image_file in enumerate(image_files):
-        image = Image.open(image_file)
+        image = frame_store.open_image(image_file)
         if should_resize:
+            # let the JPEG decoder downscale before the full frame is decoded
+            image.draft('RGB', (width, height))
             image = image.resize((width, height))
         x = (i % ncol) * width
         y = (i // ncol) * height
@@ -59,19 +90,30 @@ def create_grid_image(image_files, max_ncol = 10, border_width = 2):
     
     return grid_image
 
-def create_composite_images(frames):
+def split_composite_frames(frames):
     reduced = skip_frames(frames, 280)
     # print(f"{len(frames)} -> {len(reduced)}")
+    return [reduced[i:i+28] for i in range(0, len(reduced), 28)]
 
+def create_composite_images(frames):
     composite_images = []
 
-    for i in range(0, len(reduced), 28):
-        frames_per_image = reduced[i:i+28]
+    for frames_per_image in split_composite_frames(frames):
         composite_image = create_grid_image(frames_per_image, 4)
         composite_images.append(composite_image)
 
     return composite_images
 
+# one 4x7 grid at a time, encoded and size capped, so only a single RGB buffer is alive
+def iter_composite_images(frames, max_edge = MAX_IMAGE_EDGE, max_bytes = MAX_IMAGE_BYTES):
+    for frames_per_image in split_composite_frames(frames):
+        composite_image = create_grid_image(frames_per_image, 4, max_edge=max_edge)
+        try:
+            data = encode_jpeg(composite_image, max_bytes)
+        finally:
+            composite_image.close()
+        yield data
+
 def group_frames_to_shots(frame_embeddings, min_similarity = 0.80):
     shots = []
     current_shot = [frame_embeddings[0]]
@@ -0,0 +1,196 @@
+import os
+import csv
+import json
+import time
+import threading
+from contextlib import contextmanager
+from lib import util
+
+# counters that can be accumulated on a stage with count()
+COUNTERS = [
+    'bytes_read',
+    'bytes_written',
+    'api_calls',
+    'input_tokens',
+    'output_tokens',
+    'estimated_cost',
+]
+
+FIELDS = [
+    'run_id',
+    'video',
+    'stage',
+    'started_at',
+    'wall_s',
+    'cpu_s',
+    'child_cpu_s',
+    *COUNTERS,
+]
+
+_lock = threading.Lock()
+_records = []
+_stack = []
+_current = {
+    'run_id': time.strftime('%Y%m%d-%H%M%S'),
+    'video': None,
+}
+
+def _io_counters():
+    # rchar/wchar also include the I/O of reaped child processes (ffmpeg)
+    try:
+        with open('/proc/self/io', encoding='utf-8') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except Exception:
+        return None
+
+def _cpu_times():
+    t = os.times()
+    return (t.user + t.system, t.children_user + t.children_system)
+
+def reset(run_id=None):
+    with _lock:
+        _records.clear()
+        _stack.clear()
+        _current['run_id'] = run_id or time.strftime('%Y%m%d-%H%M%S')
+
+def records():
+    with _lock:
+        return list(_records)
+
+# stages opened without an explicit video are attributed to the current video
+def set_video(name):
+    _current['video'] = name
+
+@contextmanager
+def stage(name, video=None):
+    record = {
+        'run_id': _current['run_id'],
+        'video': video or _current['video'],
+        'stage': name,
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'wall_s': 0.0,
+        'cpu_s': 0.0,
+        'child_cpu_s': 0.0,
+        **{key: 0 for key in COUNTERS},
+    }
+    record['estimated_cost'] = 0.0
+
+    io0 = _io_counters()
+    cpu0, child_cpu0 = _cpu_times()
+    t0 = time.perf_counter()
+
+    with _lock:
+        _stack.append(record)
+    try:
+        yield record
+    finally:
+        t1 = time.perf_counter()
+        cpu1, child_cpu1 = _cpu_times()
+        io1 = _io_counters()
+
+        record['wall_s'] = round(t1 - t0, 3)
+        record['cpu_s'] = round(cpu1 - cpu0, 3)
+        record['child_cpu_s'] = round(child_cpu1 - child_cpu0, 3)
+        if io0 and io1:
+            record['bytes_read'] += io1[0] - io0[0]
+            record['bytes_written'] += io1[1] - io0[1]
+
+        with _lock:
+            _stack.remove(record)
+            _records.append(record)
+
+# accumulate counters on the innermost active stage, no-op outside of a stage
+def count(**counters):
+    unknown = set(counters) - set(COUNTERS)
+    if unknown:
+        raise ValueError(f"unknown counters: {sorted(unknown)}")
+
+    with _lock:
+        if not _stack:
+            return
+        record = _stack[-1]
+        for key, value in counters.items():
+            record[key] += value
+
+def summary(by=('video', 'stage')):
+    totals = {}
+    for record in records():
+        key = tuple(record[k] for k in by)
+        if key not in totals:
+            totals[key] = {
+                **{k: record[k] for k in by},
+                'runs': 0,
+                'wall_s': 0.0,
+                'cpu_s': 0.0,
+                'child_cpu_s': 0.0,
+                **{counter: 0 for counter in COUNTERS},
+            }
+        total = totals[key]
+        total['runs'] += 1
+        for field in ['wall_s', 'cpu_s', 'child_cpu_s', *COUNTERS]:
+            total[field] += record[field]
+
+    return list(totals.values())
+
+def export_json(output_file):
+    return util.save_to_file(output_file, {
+        'run_id': _current['run_id'],
+        'records': records(),
+    })
+
+def export_csv(output_file):
+    with open(output_file, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for record in records():
+            writer.writerow(record)
+    return output_file
+
+def load_records(file):
+    if file.endswith('.csv'):
+        with open(file, encoding='utf-8', newline='') as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            for field in ['wall_s', 'cpu_s', 'child_cpu_s', *COUNTERS]:
+                row[field] = float(row[field] or 0)
+        return rows
+
+    with open(file, encoding='utf-8') as f:
+        data = json.load(f)
+    return data['records'] if isinstance(data, dict) else data
+
+# compare two exported runs per (video, stage) and flag anything that grew beyond the tolerance
+def compare_runs(baseline_file, current_file, tolerance=0.2, fields=('wall_s', 'cpu_s', 'bytes_written', 'api_calls', 'input_tokens', 'estimated_cost')):
+    def aggregate(rows):
+        totals = {}
+        for row in rows:
+            key = (row['video'], row['stage'])
+            total = totals.setdefault(key, {field: 0 for field in fields})
+            for field in fields:
+                total[field] += float(row[field])
+        return totals
+
+    baseline = aggregate(load_records(baseline_file))
+    current = aggregate(load_records(current_file))
+
+    regressions = []
+    for key, cur in current.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        for field in fields:
+            if base[field] <= 0:
+                continue
+            change = (cur[field] - base[field]) / base[field]
+            if change > tolerance:
+                regressions.append({
+                    'video': key[0],
+                    'stage': key[1],
+                    'field': field,
+                    'baseline': base[field],
+                    'current': cur[field],
+                    'change': round(change, 4),
+                })
+
+    return regressions
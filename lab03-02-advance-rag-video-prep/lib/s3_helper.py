@@ -1,17 +1,151 @@
 import os
+import glob
+import hashlib
+import threading
 import boto3
 import sagemaker
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from lib import metrics
+
+MAX_WORKERS = 16
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=MULTIPART_THRESHOLD,
+    multipart_chunksize=MULTIPART_CHUNKSIZE,
+    max_concurrency=4,
+)
+
+_client = None
+_client_lock = threading.Lock()
+
+# one client for all uploads, boto3 clients are thread safe
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = boto3.client('s3', config=Config(max_pool_connections=MAX_WORKERS * 4))
+        return _client
 
 def upload_object(bucket, prefix, file):
-    
+
     key = os.path.join(prefix, file)
 
-    s3_client = boto3.client('s3')
+    s3_client = get_client()
+
+    with metrics.stage('upload_object', Path(file).stem):
+        with open(file, "rb") as f:
+            response = s3_client.put_object(
+                Body=f,
+                Bucket=bucket,
+                Key=key,
+            )
+        metrics.count(api_calls=1)
+    return response
+
+def file_md5(file, chunksize = MULTIPART_CHUNKSIZE):
+    md5 = hashlib.md5()
+    part_digests = []
+    with open(file, 'rb') as f:
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            md5.update(chunk)
+            part_digests.append(hashlib.md5(chunk).digest())
+    return md5.hexdigest(), part_digests
+
+# the ETag S3 computes for a multipart upload is the md5 of the part md5s followed by the number of parts
+def multipart_etag(part_digests):
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+def is_unchanged(bucket, key, file, md5 = None, part_digests = None):
+    try:
+        head = get_client().head_object(Bucket=bucket, Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return False
+        raise e
+    metrics.count(api_calls=1)
+
+    if head['ContentLength'] != os.path.getsize(file):
+        return False
+
+    if md5 is None:
+        md5, part_digests = file_md5(file)
+
+    if head.get('Metadata', {}).get('md5') == md5:
+        return True
+
+    etag = head['ETag'].strip('"')
+    if '-' in etag:
+        return etag == multipart_etag(part_digests)
+    return etag == md5
+
+def _upload_file(bucket, key, file, skip_unchanged):
+    md5, part_digests = file_md5(file)
+
+    if skip_unchanged and is_unchanged(bucket, key, file, md5, part_digests):
+        return 'skipped'
+
+    # upload_file switches to multipart above the threshold, the md5 is kept as metadata for the next run
+    get_client().upload_file(
+        file,
+        bucket,
+        key,
+        ExtraArgs={'Metadata': {'md5': md5}},
+        Config=TRANSFER_CONFIG,
+    )
+    metrics.count(api_calls=1)
+    return 'uploaded'
+
+def upload_files(bucket, prefix, files, max_workers = MAX_WORKERS, skip_unchanged = True):
+    # files can be a list of paths or (file, key) tuples
+    items = []
+    for file in files:
+        if isinstance(file, (tuple, list)):
+            items.append((file[0], file[1]))
+        else:
+            items.append((file, os.path.join(prefix, file)))
+
+    results = {
+        'uploaded': [],
+        'skipped': [],
+        'failed': [],
+    }
+
+    with metrics.stage('upload_files'):
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(_upload_file, bucket, key, file, skip_unchanged): (file, key)
+                for file, key in items
+            }
+            for future in as_completed(futures):
+                file, key = futures[future]
+                try:
+                    results[future.result()].append(key)
+                except Exception as e:
+                    print(f"ERR: upload_files: {file}: {str(e)}")
+                    results['failed'].append(key)
+
+        metrics.count(bytes_written=sum(os.path.getsize(file) for file, key in items if key in results['uploaded']))
+
+    print(f"upload_files: {len(results['uploaded'])} uploaded, {len(results['skipped'])} unchanged, {len(results['failed'])} failed")
+    return results
 
-    with open(file, "rb") as f:
-        response = s3_client.put_object(
-            Body=f,
-            Bucket=bucket,
-            Key=key,
-        )
-    return response
\ No newline at end of file
+# similar to `aws s3 sync`, keys are relative to the directory
+def upload_directory(bucket, prefix, directory, pattern = '**/*', max_workers = MAX_WORKERS, skip_unchanged = True):
+    files = [
+        file for file in sorted(glob.glob(os.path.join(directory, pattern), recursive=True))
+        if os.path.isfile(file)
+    ]
+    items = [
+        (file, os.path.join(prefix, os.path.relpath(file, directory)))
+        for file in files
+    ]
+    return upload_files(bucket, prefix, items, max_workers, skip_unchanged)
@@ -0,0 +1,169 @@
+import os
+import copy
+import json
+import time
+import numpy as np
+from pathlib import Path
+from PIL import ImageFilter
+from termcolor import colored
+from lib import frames
+from lib import embeddings
+from lib import frame_store
+
+HSV_BINS = (16, 4, 4)
+EDGE_SIZE = (96, 54)
+
+def frame_no_from_file(jpeg_file):
+    return int(Path(jpeg_file).stem.split('.')[1]) - 1
+
+def frame_signature(image, bins = HSV_BINS, edge_size = EDGE_SIZE, edge_threshold = 32):
+    # quantized HSV color histogram
+    hsv = np.asarray(image.convert('HSV'), dtype=np.int32)
+    h = (hsv[..., 0] * bins[0]) >> 8
+    s = (hsv[..., 1] * bins[1]) >> 8
+    v = (hsv[..., 2] * bins[2]) >> 8
+    idx = (h * bins[1] + s) * bins[2] + v
+    histogram = np.bincount(idx.ravel(), minlength=bins[0] * bins[1] * bins[2]).astype(np.float32)
+    histogram /= histogram.sum()
+
+    # binary edge map and its dilation for the edge change ratio
+    gray = image.convert('L').resize(edge_size)
+    edge_image = gray.filter(ImageFilter.FIND_EDGES)
+    edges = np.asarray(edge_image) > edge_threshold
+    dilated = np.asarray(edge_image.filter(ImageFilter.MaxFilter(3))) > edge_threshold
+
+    return {
+        'histogram': histogram,
+        'edges': edges,
+        'dilated': dilated,
+    }
+
+def frame_difference(prev, cur):
+    # histogram total variation distance in [0, 1]
+    hist_diff = 0.5 * float(np.abs(prev['histogram'] - cur['histogram']).sum())
+
+    # edge change ratio in [0, 1]: share of entering / exiting edge pixels
+    cur_edges = cur['edges'].sum()
+    prev_edges = prev['edges'].sum()
+    entering = 1.0 - (cur['edges'] & prev['dilated']).sum() / cur_edges if cur_edges else 0.0
+    exiting = 1.0 - (prev['edges'] & cur['dilated']).sum() / prev_edges if prev_edges else 0.0
+    edge_diff = float(max(entering, exiting))
+
+    return hist_diff, edge_diff
+
+def detect_shots(jpeg_files, threshold = 0.45, hist_weight = 0.6, min_shot_length = 1):
+    jpeg_files = sorted(jpeg_files, key=frame_no_from_file)
+
+    shots = []
+    current_shot = []
+    prev = None
+
+    for jpeg_file in jpeg_files:
+        with frame_store.open_image(jpeg_file) as image:
+            cur = frame_signature(image)
+
+        frame_no = frame_no_from_file(jpeg_file)
+
+        if prev is not None:
+            hist_diff, edge_diff = frame_difference(prev, cur)
+            score = (hist_weight * hist_diff) + ((1 - hist_weight) * edge_diff)
+            if score > threshold and len(current_shot) >= min_shot_length:
+                shots.append(current_shot)
+                current_shot = []
+
+        current_shot.append(frame_no)
+        prev = cur
+
+    if current_shot:
+        shots.append(current_shot)
+
+    return [{
+        'shot_id': i,
+        'frame_ids': shot,
+    } for i, shot in enumerate(shots)]
+
+def select_keyframes(frames_in_shots, per_shot = 1):
+    # evenly spaced frames within each shot, the middle frame for a single keyframe
+    for frames_in_shot in frames_in_shots:
+        frame_ids = frames_in_shot['frame_ids']
+        n = min(per_shot, len(frame_ids))
+        step = len(frame_ids) / n
+        frames_in_shot['keyframe_ids'] = sorted(set(
+            frame_ids[int((i + 0.5) * step)] for i in range(n)
+        ))
+
+    return frames_in_shots
+
+def _boundaries(frames_in_shots):
+    return [min(shot['frame_ids']) for shot in frames_in_shots[1:]]
+
+def _match_boundaries(detected, reference, tolerance):
+    matched = 0
+    unmatched = sorted(reference)
+    for boundary in sorted(detected):
+        for candidate in unmatched:
+            if abs(candidate - boundary) <= tolerance:
+                unmatched.remove(candidate)
+                matched += 1
+                break
+    return matched
+
+def benchmark(video_dir, min_similarity = 0.80, tolerance = 1, per_shot = 1, display = True, embeddings_file = None, **kwargs):
+    # compare the histogram/edge detector against the embedding based segmentation of an already processed video,
+    # the reference needs one embedding per frame (embeddings_file defaults to the frame_embeddings.json of the video)
+    embeddings_file = embeddings_file or os.path.join(video_dir, 'frame_embeddings.json')
+    with open(embeddings_file, encoding="utf-8") as f:
+        frame_embeddings = json.load(f)
+
+    # a keyframe run copies the keyframe embedding to the other frames of its shot, grouping them would only
+    # find the boundaries the detector produced itself
+    if any('keyframe' in frame for frame in frame_embeddings):
+        raise ValueError(f"{embeddings_file} comes from a keyframe run, benchmark needs the embeddings of a full run (batch_generate_embeddings without frames_in_shots)")
+
+    jpeg_files = frame_store.list_frames(os.path.join(video_dir, 'frames'))
+
+    t0 = time.time()
+    detected = detect_shots(jpeg_files, **kwargs)
+    t1 = time.time()
+    reference = frames.group_frames_to_shots(copy.deepcopy(frame_embeddings), min_similarity)
+    t2 = time.time()
+
+    detected_boundaries = _boundaries(detected)
+    reference_boundaries = _boundaries(reference)
+    matched = _match_boundaries(detected_boundaries, reference_boundaries, tolerance)
+
+    precision = matched / len(detected_boundaries) if detected_boundaries else 1.0
+    recall = matched / len(reference_boundaries) if reference_boundaries else 1.0
+    f1 = (2 * precision * recall / (precision + recall)) if (precision + recall) > 0 else 0.0
+
+    num_keyframes = sum(len(shot['keyframe_ids']) for shot in select_keyframes(detected, per_shot))
+    num_embeddings = len([frame for frame in frame_embeddings if frame.get('keyframe', True)])
+    embedding_cost = num_embeddings * embeddings.TITAN_PRICING
+    keyframe_cost = num_keyframes * embeddings.TITAN_PRICING
+
+    result = {
+        'video': Path(video_dir).name,
+        'num_frames': len(jpeg_files),
+        'detected_shots': len(detected),
+        'reference_shots': len(reference),
+        'precision': round(precision, 4),
+        'recall': round(recall, 4),
+        'f1': round(f1, 4),
+        'detect_elapsed': round(t1 - t0, 2),
+        'group_elapsed': round(t2 - t1, 2),
+        'embeddings_full': num_embeddings,
+        'embeddings_keyframes': num_keyframes,
+        'estimated_cost_full': embedding_cost,
+        'estimated_cost_keyframes': keyframe_cost,
+    }
+
+    if display:
+        print('\n')
+        print('========================================================================')
+        print(f"{result['video']}: {result['detected_shots']} shots detected vs {result['reference_shots']} shots from embeddings ({result['num_frames']} frames)")
+        print('Boundary precision:', colored(result['precision'], 'green'), 'recall:', colored(result['recall'], 'green'), 'F1:', colored(result['f1'], 'green'), f"(tolerance {tolerance} frames)")
+        print(f"Detector: {result['detect_elapsed']}s on CPU")
+        print('Embeddings:', colored(num_keyframes, 'green'), f"keyframes instead of {num_embeddings} frames,", colored(f"${round(keyframe_cost, 4)}", 'green'), f"instead of ${round(embedding_cost, 4)}")
+        print('========================================================================')
+
+    return result
@@ -5,6 +5,7 @@ from pathlib import Path
 #from urllib.request import urlretrieve
 from termcolor import colored
 import requests
+from lib import metrics
 
 def url_retrieve(url: str, outfile: Path):
     
@@ -13,11 +14,12 @@ def url_retrieve(url: str, outfile: Path):
     with open(outfile,'wb') as f:
       f.write(r.content)
 
-def transcribe(bucket, path, file, media_format="mp4", language_code="en-US", verbose=True):
+def transcribe(bucket, path, file, media_format="mp4", language_code="en-US", verbose=True, video_dir=None, vtt_file_name='transcript.vtt'):
 
     # check to see if transcript already exists
-    video_dir = Path(file).stem
-    if os.path.exists(os.path.join(video_dir, 'transcript.vtt')):
+    if video_dir is None:
+        video_dir = Path(file).stem
+    if os.path.exists(os.path.join(video_dir, vtt_file_name)):
         print(colored(f"Transcript already exists for {file}", 'yellow'))
         return None
 
@@ -25,7 +27,7 @@ def transcribe(bucket, path, file, media_format="mp4", language_code="en-US", ve
     transcribe_response = start_transcription_job(
         bucket, 
         path,
-        file, media_format, language_code)
+        file, media_format, language_code, job_prefix=video_dir)
 
     # wait for completion
     transcribe_response = wait_for_transcription_job(
@@ -34,11 +36,11 @@ def transcribe(bucket, path, file, media_format="mp4", language_code="en-US", ve
 
     return transcribe_response
 
-def start_transcription_job(bucket, path, file, media_format="mp4", language_code="en-US"):
+def start_transcription_job(bucket, path, file, media_format="mp4", language_code="en-US", job_prefix=None):
 
     # create a random job name
     job_name = '-'.join([
-        Path(file).stem,
+        Path(job_prefix or file).stem,
         os.urandom(4).hex(),
     ])
 
@@ -59,6 +61,7 @@ def start_transcription_job(bucket, path, file, media_format="mp4", language_cod
             ],
         },
     )
+    metrics.count(api_calls=1)
 
     return response
 
@@ -70,6 +73,7 @@ def wait_for_transcription_job(job_name, verbose=True):
             response = transcribe_client.get_transcription_job(
                 TranscriptionJobName=job_name
             )
+            metrics.count(api_calls=1)
             transcription_job_status = response['TranscriptionJob']['TranscriptionJobStatus']
             if verbose: 
                 print(f"wait_for_transcription_job: status = {transcription_job_status}")
@@ -102,9 +106,9 @@ def display_transcription_cost(duration_ms, display=True):
     
     return transcribe_cost
 
-def download_vtt(response, output_dir = ''):
+def download_vtt(response, output_dir = '', file_name = 'transcript.vtt'):
 
-    output_file = os.path.join(output_dir, 'transcript.vtt')
+    output_file = os.path.join(output_dir, file_name)
     if os.path.exists(output_file):
         return output_file
 
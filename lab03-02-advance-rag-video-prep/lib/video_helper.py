@@ -5,6 +5,9 @@ from lib import util
 from lib import embeddings
 from lib import frames
 from lib import ffmpeg_helper as ffh
+from lib import s3_helper as s3h
+from lib import metrics
+from lib import shot_detector
 from pathlib import Path
 import re
 import os
@@ -34,17 +37,54 @@ def get_chapter_frames(frame_embeddings, scenes_in_chapters):
     return chapters_frames
 
 
-def generate_chapeter_segements(mp4_file, video_dir, bucket, duration_ms):
-    
-    transcribe_response = trh.transcribe(bucket, "contextual_ad", mp4_file)
+def transcribe_trimmed_audio(mp4_file, video_dir, bucket, duration_ms, codec='flac'):
+    # transcribe a silence-trimmed FLAC/Opus track instead of the full mp4
+    audio_file, offset_map = ffh.prepare_audio(mp4_file, duration_ms, codec=codec)
+
+    trimmed_vtt_file = 'transcript.trimmed.vtt'
+    if not os.path.exists(os.path.join(video_dir, trimmed_vtt_file)):
+        s3h.upload_object(bucket, "contextual_ad", audio_file)
+
+    transcribe_response = trh.transcribe(bucket, "contextual_ad", audio_file,
+                                         media_format=ffh.AUDIO_FORMATS[codec]['media_format'],
+                                         video_dir=video_dir,
+                                         vtt_file_name=trimmed_vtt_file)
+
+    trh.download_transcript(transcribe_response, output_dir = video_dir)
+
+    trimmed_vtt_filename = trh.download_vtt(transcribe_response, output_dir = video_dir, file_name = trimmed_vtt_file)
+
+    # map the caption timestamps back to the source timeline
+    vtt_filename = chpt.remap_webvtt(trimmed_vtt_filename, offset_map, os.path.join(video_dir, 'transcript.vtt'))
+
+    # billed on the trimmed duration
+    trimmed_ms = offset_map[-1]['end_ms']
+    print(f"Transcribing {round(trimmed_ms / 1000, 2)}s of {round(duration_ms / 1000, 2)}s audio")
+
+    return vtt_filename, trimmed_ms
+
+
+def generate_chapeter_segements(mp4_file, video_dir, bucket, duration_ms, audio_prep=None, compact_transcript=False, window_ms=None):
+    metrics.set_video(video_dir)
 
-    transcript_filename = trh.download_transcript(transcribe_response, output_dir = video_dir)
+    with metrics.stage('transcribe'):
+        if audio_prep:
+            vtt_filename, duration_ms = transcribe_trimmed_audio(mp4_file, video_dir, bucket, duration_ms, codec=audio_prep)
+        else:
+            transcribe_response = trh.transcribe(bucket, "contextual_ad", mp4_file)
 
-    vtt_filename = trh.download_vtt(transcribe_response, output_dir = video_dir)
+            transcript_filename = trh.download_transcript(transcribe_response, output_dir = video_dir)
 
-    transcribe_cost = trh.display_transcription_cost(duration_ms, display=False)
+            vtt_filename = trh.download_vtt(transcribe_response, output_dir = video_dir)
 
-    conversation_response = brh.analyze_conversations(vtt_filename)
+        transcribe_cost = trh.display_transcription_cost(duration_ms, display=False)
+        metrics.count(estimated_cost=transcribe_cost['estimated_cost'])
+
+    # long transcripts are analyzed in overlapping windows
+    if window_ms and duration_ms > window_ms:
+        conversation_response = brh.analyze_conversations_windowed(vtt_filename, window_ms=window_ms, compact=compact_transcript)
+    else:
+        conversation_response = brh.analyze_conversations(vtt_filename, compact=compact_transcript)
 
     # show the conversation cost
     conversation_cost = brh.display_conversation_cost(conversation_response, display=False)
@@ -56,7 +96,7 @@ def generate_chapeter_segements(mp4_file, video_dir, bucket, duration_ms):
     chapters = chpt.merge_chapters(conversations['chapters'])
     
     ## validate the conversation timestamps against the caption timestamps
-    captions = chpt.parse_webvtt(vtt_filename)
+    captions = chpt.parse_webvtt_arrays(vtt_filename)
     chapters = chpt.validate_timestamps(chapters, captions)
     
     conversations['chapters'] = chapters
@@ -67,20 +107,32 @@ def generate_chapeter_segements(mp4_file, video_dir, bucket, duration_ms):
     return conversations, transcribe_cost, conversation_cost
 
 
-def group_scene_segements(file_name, video_dir, stream_info):
+def group_scene_segements(file_name, video_dir, stream_info, shot_detection='embedding', keyframes_per_shot=1, packed_frames=False):
+    metrics.set_video(video_dir)
 
-    jpeg_files = ffh.extract_frames(file_name, stream_info, (392, 220))
+    jpeg_files = ffh.extract_frames(file_name, stream_info, (392, 220), packed=packed_frames)
 
     print(f"Frame extracted: {len(jpeg_files)}")
 
-    # generate embeddings =================================
-    
-    frame_embeddings = embeddings.batch_generate_embeddings(jpeg_files, output_dir = video_dir)
+    if shot_detection == 'histogram':
+        # detect shots locally and only embed the keyframes of each shot ==========
+        with metrics.stage('detect_shots'):
+            frames_in_shots = shot_detector.detect_shots(jpeg_files)
+            shot_detector.select_keyframes(frames_in_shots, keyframes_per_shot)
+
+        frame_embeddings = embeddings.batch_generate_embeddings(jpeg_files, output_dir = video_dir, frames_in_shots = frames_in_shots)
+
+        frame_embeddings_cost = embeddings.display_embedding_cost(frame_embeddings, display=False)
+    else:
+        # generate embeddings =================================
+        
+        frame_embeddings = embeddings.batch_generate_embeddings(jpeg_files, output_dir = video_dir)
 
-    frame_embeddings_cost = embeddings.display_embedding_cost(frame_embeddings, display=False)
+        frame_embeddings_cost = embeddings.display_embedding_cost(frame_embeddings, display=False)
 
-    # group frames into shots ================================
-    frames_in_shots = frames.group_frames_to_shots(frame_embeddings)
+        # group frames into shots ================================
+        with metrics.stage('group_frames_to_shots'):
+            frames_in_shots = frames.group_frames_to_shots(frame_embeddings)
 
     print(f"Number of shots: {len(frames_in_shots)} from {len(frame_embeddings)} frames")
 
@@ -211,6 +263,7 @@ def generate_contextual_output(file_name, video_dir, scene_doc_dir, scenes_in_ch
     }
 
     prefix = Path(file_name).stem
+    metrics.set_video(video_dir)
     
     for frames_in_chapter in frames_in_chapters:
         chapter_id = frames_in_chapter['chapter_id']
@@ -219,20 +272,10 @@ def generate_contextual_output(file_name, video_dir, scene_doc_dir, scenes_in_ch
 
         start, end = extract_min_max_timestamp(ch_frames)
     
-        composite_images = frames.create_composite_images(ch_frames)
-        num_images = len(composite_images)
-    
-        for j in range(num_images):
-            composite_image = composite_images[j]
-            w, h = composite_image.size
-            scaled = composite_image.resize((w // 4, h // 4))
-
+        with metrics.stage('create_composite_images'):
+            composite_images = list(frames.iter_composite_images(ch_frames))
 
         contextual_response = brh.get_contextual_information(composite_images, text)
-            
-        # close the images
-        for composite_image in composite_images:
-            composite_image.close()
     
         usage = contextual_response['usage']
         contextual = contextual_response['content'][0]['json']
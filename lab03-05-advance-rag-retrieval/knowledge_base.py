@@ -6,6 +6,7 @@ from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth, Re
 import pprint
 from retrying import retry
 import zipfile
+import threading
 from io import BytesIO
 import warnings
 warnings.filterwarnings('ignore')
@@ -22,8 +23,65 @@ embedding_context_dimensions = {
     "amazon.titan-embed-text-v1": 1536,
     "amazon.titan-embed-text-v2:0": 1024
 }
+
+# knn_vector storage profiles: faiss fp16 scalar quantization halves the graph memory,
+# the knowledge base writes float embeddings so byte vectors are not an option here
+vector_profiles = {
+    "float32": {},
+    "fp16": {"encoder": {"name": "sq", "parameters": {"type": "fp16"}}},
+}
 pp = pprint.PrettyPrinter(indent=2)
 
+# session, account id, boto3 clients and OpenSearch clients shared by all BedrockKnowledgeBase objects
+_shared = {"session": None, "account_id": None, "clients": {}, "oss_clients": {}}
+_shared_lock = threading.RLock()
+
+
+def get_session():
+    with _shared_lock:
+        if _shared["session"] is None:
+            _shared["session"] = boto3.session.Session()
+        return _shared["session"]
+
+
+def get_account_id():
+    with _shared_lock:
+        if _shared["account_id"] is None:
+            _shared["account_id"] = get_client('sts').get_caller_identity()["Account"]
+        return _shared["account_id"]
+
+
+def get_client(service_name):
+    with _shared_lock:
+        if service_name not in _shared["clients"]:
+            _shared["clients"][service_name] = get_session().client(service_name)
+        return _shared["clients"][service_name]
+
+
+def get_oss_client(host, region_name, http_compress=False):
+    """
+    OpenSearch client for a collection endpoint, created once per (host, region) and reused so searches keep warm connections
+    Args:
+        host (str): collection endpoint
+        region_name (str): region of the collection
+        http_compress (bool): gzip the requests and accept gzipped responses
+    """
+    key = (host, region_name, http_compress)
+    with _shared_lock:
+        if key not in _shared["oss_clients"]:
+            # the session credentials refresh themselves, the signer reads them on every request
+            awsauth = AWSV4SignerAuth(get_session().get_credentials(), region_name, 'aoss')
+            _shared["oss_clients"][key] = OpenSearch(
+                hosts=[{'host': host, 'port': 443}],
+                http_auth=awsauth,
+                use_ssl=True,
+                verify_certs=True,
+                connection_class=RequestsHttpConnection,
+                pool_maxsize=20,
+                http_compress=http_compress,
+            )
+        return _shared["oss_clients"][key]
+
 
 def interactive_sleep(seconds: int):
     """
@@ -38,6 +96,57 @@ def interactive_sleep(seconds: int):
         time.sleep(1)
 
 
+def wait_until(probe, description, timeout=300, initial_interval=1, max_interval=15):
+    """
+    Poll a readiness probe with exponential backoff until it returns a truthy value
+    Args:
+        probe (callable): returns a truthy value once the resource is usable, exceptions count as not ready
+        description (str): what is being waited for, used in the messages
+        timeout (int): seconds before giving up
+        initial_interval (int): seconds before the second attempt, doubled after every attempt
+        max_interval (int): upper bound of the interval between attempts
+    """
+    t0 = time.time()
+    interval = initial_interval
+    last_error = None
+    while True:
+        try:
+            result = probe()
+            if result:
+                print(f"{description} ready after {time.time() - t0:.1f}s")
+                return result
+        except Exception as e:
+            last_error = e
+        if time.time() - t0 + interval > timeout:
+            raise Exception(f"{description} not ready after {timeout}s, last error: {last_error}")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+
+def index_ready(oss_client, index_name):
+    """
+    The index exists and answers searches
+    Args:
+        oss_client (OpenSearch): client of the collection
+        index_name (str): index to probe
+    """
+    if not oss_client.indices.exists(index=index_name):
+        return False
+    oss_client.search(index=index_name, body={"size": 0, "query": {"match_all": {}}})
+    return True
+
+
+def index_has_documents(oss_client, index_name):
+    """
+    Number of searchable documents in the index, 0 until the ingested documents are visible
+    Args:
+        oss_client (OpenSearch): client of the collection
+        index_name (str): index to probe
+    """
+    response = oss_client.search(index=index_name, body={"size": 0, "track_total_hits": True, "query": {"match_all": {}}})
+    return response["hits"]["total"]["value"]
+
+
 class BedrockKnowledgeBase:
 
     def __init__(
@@ -53,7 +162,9 @@ class BedrockKnowledgeBase:
             index_name,
             suffix,
             embedding_model="amazon.titan-embed-text-v2:0",
-            chunking_strategy="FIXED_SIZE"
+            chunking_strategy="FIXED_SIZE",
+            vector_profile="float32",
+            http_compress=False
     ):
         """
         Class initializer
@@ -65,16 +176,18 @@ class BedrockKnowledgeBase:
             embedding_model(str): The embedding model to be used for the Knowledge Base.
             chunking_strategy(str): The chunking strategy to be used for the Knowledge Base.
             suffix(str): A suffix to be used for naming resources.
+            vector_profile(str): The knn_vector storage profile, float32 or fp16.
+            http_compress(bool): Gzip the requests to the vector store and accept gzipped responses.
         """
-        self.boto3_session = boto3.session.Session()
+        self.boto3_session = get_session()
         self.region_name = self.boto3_session.region_name
-        self.sts_client = self.boto3_session.client('sts')
-        self.account_id = self.sts_client.get_caller_identity()["Account"]
+        self.sts_client = get_client('sts')
+        self.account_id = get_account_id()
         self.credentials = self.boto3_session.get_credentials()
 
         # oss attributes
         self.awsauth = AWSV4SignerAuth(self.credentials, self.region_name, 'aoss')
-        self.aoss_client = self.boto3_session.client('opensearchserverless')
+        self.aoss_client = get_client('opensearchserverless')
         self.bucket_name = data_bucket_name
         self.data_prefix = data_prefix
         self.host = vector_host
@@ -83,13 +196,7 @@ class BedrockKnowledgeBase:
         self.index_name = index_name
         
         
-        self.oss_client = OpenSearch(
-            hosts=[{'host': self.host, 'port': 443}],
-            http_auth=self.awsauth,
-            use_ssl=True,
-            verify_certs=True,
-            connection_class=RequestsHttpConnection,
-        )
+        self.oss_client = get_oss_client(self.host, self.region_name, http_compress)
 
         # knowledge base attributes
         self.kb_name = kb_name
@@ -99,9 +206,13 @@ class BedrockKnowledgeBase:
             valid_embeddings_str = str(valid_embedding_models)
             raise ValueError(f"Invalid embedding model. Your embedding model should be one of {valid_embeddings_str}")
 
+        if vector_profile not in vector_profiles:
+            raise ValueError(f"Invalid vector profile. Your vector profile should be one of {list(vector_profiles)}")
+        self.vector_profile = vector_profile
+
         # bedrock attributes
-        self.s3_client = self.boto3_session.client('s3')
-        self.bedrock_agent_client = self.boto3_session.client('bedrock-agent')
+        self.s3_client = get_client('s3')
+        self.bedrock_agent_client = get_client('bedrock-agent')
         self.embedding_model = embedding_model
         self.kb_execution_role_name = bedrock_kb_execution_role_arn
 
@@ -133,7 +244,8 @@ class BedrockKnowledgeBase:
                         "method": {
                             "name": "hnsw",
                             "engine": "faiss",
-                            "space_type": "l2"
+                            "space_type": "l2",
+                            "parameters": vector_profiles[self.vector_profile]
                         },
                     },
                     "text": {
@@ -152,7 +264,7 @@ class BedrockKnowledgeBase:
             pp.pprint(response)
 
             # index creation can take up to a minute
-            interactive_sleep(60)
+            wait_until(lambda: index_ready(self.oss_client, self.index_name), f"Index {self.index_name}")
         except RequestError as e:
             # you can delete the index if its already exists
             # oss_client.indices.delete(index=index_name)
@@ -253,6 +365,12 @@ class BedrockKnowledgeBase:
             kb = response['knowledgeBase']
             pp.pprint(kb)
 
+        # the data source and ingestion job need an ACTIVE knowledge base
+        kb_id = kb['knowledgeBaseId']
+        kb = wait_until(lambda: self.knowledge_base_settled(kb_id), f"Knowledge base {self.kb_name}")
+        if kb['status'] != 'ACTIVE':
+            raise Exception(f"Knowledge base {kb_id} is {kb['status']}: {kb.get('failureReasons')}")
+
         # Create a DataSource in KnowledgeBase
         try:
             print(self.kb_name)
@@ -284,6 +402,15 @@ class BedrockKnowledgeBase:
             pp.pprint(ds)
         return kb, ds
 
+    def knowledge_base_settled(self, kb_id):
+        """
+        Knowledge base description once it is ACTIVE or FAILED, None while it is being created or updated
+        Args:
+            kb_id (str): id of the knowledge base
+        """
+        kb = self.bedrock_agent_client.get_knowledge_base(knowledgeBaseId=kb_id)['knowledgeBase']
+        return kb if kb['status'] in ['ACTIVE', 'FAILED', 'DELETE_UNSUCCESSFUL'] else None
+
     def start_ingestion_job(self):
         """
         Start an ingestion job to synchronize data from an S3 bucket to the Knowledge Base
@@ -296,15 +423,24 @@ class BedrockKnowledgeBase:
         job = start_job_response["ingestionJob"]
         pp.pprint(job)
         # Get job
-        while job['status'] != 'COMPLETE':
+        def job_finished():
             get_job_response = self.bedrock_agent_client.get_ingestion_job(
                 knowledgeBaseId=self.knowledge_base['knowledgeBaseId'],
                 dataSourceId=self.data_source["dataSourceId"],
                 ingestionJobId=job["ingestionJobId"]
             )
-            job = get_job_response["ingestionJob"]
+            job.update(get_job_response["ingestionJob"])
+            return job['status'] in ['COMPLETE', 'FAILED']
+
+        wait_until(job_finished, "Ingestion job", timeout=3600, max_interval=30)
         pp.pprint(job)
-        interactive_sleep(40)
+        if job['status'] == 'FAILED':
+            raise Exception(f"Ingestion job failed: {job.get('failureReasons')}")
+
+        # the indexed documents become searchable shortly after the job completes
+        statistics = job.get('statistics', {})
+        if statistics.get('numberOfNewDocumentsIndexed', 0) + statistics.get('numberOfModifiedDocumentsIndexed', 0) > 0:
+            wait_until(lambda: index_has_documents(self.oss_client, self.index_name), f"Documents in {self.index_name}")
 
     def get_knowledge_base_id(self):
         """
@@ -3,19 +3,89 @@ from dataclasses import dataclass, field
 import os
 import boto3
 import time
+import threading
+from botocore.exceptions import ClientError
 from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
 
-def create_index(host, region, credentials, index_name, embedding_dim):
-    service = 'aoss'
-    auth = AWSV4SignerAuth(credentials, region, service)
-    aoss_pyclient = OpenSearch(
-        hosts = [{'host': host, 'port': 443}],
-        http_auth = auth,
-        use_ssl = True,
-        verify_certs = True,
-        connection_class = RequestsHttpConnection,
-        pool_maxsize = 20
-    )
+# knn_vector storage profiles: faiss fp16 scalar quantization halves the graph memory,
+# the knowledge base writes float embeddings so byte vectors are not an option here
+VECTOR_PROFILES = {
+    "float32": {},
+    "fp16": {"encoder": {"name": "sq", "parameters": {"type": "fp16"}}},
+}
+
+# poll a readiness probe with exponential backoff until it returns a truthy value,
+# exceptions count as not ready when retry_if accepts them (all of them by default) and are raised otherwise
+def wait_until(probe, description, timeout=300, initial_interval=1, max_interval=15, retry_if=None):
+    t0 = time.time()
+    interval = initial_interval
+    last_error = None
+    while True:
+        try:
+            result = probe()
+            if result:
+                print(f"{description} ready after {time.time() - t0:.1f}s")
+                return result
+        except Exception as e:
+            if retry_if is not None and not retry_if(e):
+                raise
+            last_error = e
+        if time.time() - t0 + interval > timeout:
+            raise Exception(f"{description} not ready after {timeout}s, last error: {last_error}")
+        time.sleep(interval)
+        interval = min(interval * 2, max_interval)
+
+def index_ready(aoss_pyclient, index_name):
+    if not aoss_pyclient.indices.exists(index=index_name):
+        return False
+    aoss_pyclient.search(index=index_name, body={"size": 0, "query": {"match_all": {}}})
+    return True
+
+def error_code(error):
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code")
+    return None
+
+# Bedrock rejects a role it cannot assume yet with a ValidationException naming the role,
+# other validation errors (bad model ARN, bad index config, ...) will not go away by retrying
+def is_role_propagation_error(error):
+    if error_code(error) != "ValidationException":
+        return False
+    message = error.response.get("Error", {}).get("Message", "").lower()
+    return "role" in message and ("assume" in message or "not able" in message or "not authorized" in message)
+
+# only proves the role is visible in IAM, Bedrock may still be unable to assume it for a while
+def role_exists(role_arn):
+    iam = boto3.client("iam")
+    return iam.get_role(RoleName=role_arn.split("/")[-1])["Role"]
+
+# one OpenSearch client per (host, region), the connection pool and signer are reused across calls
+_oss_clients = {}
+_oss_clients_lock = threading.Lock()
+
+def get_oss_client(host, region, credentials, http_compress=False):
+    key = (host, region, http_compress)
+    with _oss_clients_lock:
+        if key not in _oss_clients:
+            # refreshable session credentials are read by the signer on every request
+            service = 'aoss'
+            auth = AWSV4SignerAuth(credentials, region, service)
+            _oss_clients[key] = OpenSearch(
+                hosts = [{'host': host, 'port': 443}],
+                http_auth = auth,
+                use_ssl = True,
+                verify_certs = True,
+                connection_class = RequestsHttpConnection,
+                pool_maxsize = 20,
+                http_compress = http_compress
+            )
+        return _oss_clients[key]
+
+def create_index(host, region, credentials, index_name, embedding_dim, vector_profile="float32", http_compress=False):
+    if vector_profile not in VECTOR_PROFILES:
+        raise ValueError(f"Invalid vector profile. Your vector profile should be one of {list(VECTOR_PROFILES)}")
+
+    aoss_pyclient = get_oss_client(host, region, credentials, http_compress)
 
     index_body = {
         "settings": {
@@ -42,18 +112,21 @@ def create_index(host, region, credentials, index_name, embedding_dim):
               "method": {
                 "engine": "faiss",
                 "name": "hnsw",
-                "parameters": {}
+                "parameters": VECTOR_PROFILES[vector_profile]
               }
             }
           }
         }
     }
     response = aoss_pyclient.indices.create(index_name, body=index_body)
+    wait_until(lambda: index_ready(aoss_pyclient, index_name), f"Index {index_name}")
     return response
 
 def _create_knowledge_base(knowledge_base_name, role_arn, embedding_model_arn, collection_arn, index_name, bucket, s3_prefix):
     bedrock_agent = boto3.client("bedrock-agent")
-    response = bedrock_agent.create_knowledge_base(
+    # a freshly created role can be rejected until IAM has propagated it, only that error is retried,
+    # anything else (conflicting name, access denied, invalid config) is raised right away
+    response = wait_until(lambda: bedrock_agent.create_knowledge_base(
         name=knowledge_base_name,
         description='Knowledge Base for Bedrock',
         roleArn=role_arn,
@@ -75,7 +148,7 @@ def _create_knowledge_base(knowledge_base_name, role_arn, embedding_model_arn, c
                 }
             }
         }
-    )
+    ), f"Knowledge base {knowledge_base_name}", timeout=120, retry_if=is_role_propagation_error)
     knowledge_base_id = response['knowledgeBase']['knowledgeBaseId']
     knowledge_base_name = response['knowledgeBase']['name']
 
@@ -104,10 +177,10 @@ def _create_knowledge_base(knowledge_base_name, role_arn, embedding_model_arn, c
     data_source_id = response['dataSource']['dataSourceId']
 
     # Check status to make sure the KB is created before we could start the ingestion job.
-    kb_status = bedrock_agent.get_knowledge_base(knowledgeBaseId=knowledge_base_id)
-    while kb_status not in [ "ACTIVE", "FAILED", "DELETE_UNSUCCESSFUL" ]:
-        response = bedrock_agent.get_knowledge_base(knowledgeBaseId=knowledge_base_id)
-        kb_status = response['knowledgeBase']['status']
+    def kb_settled():
+        status = bedrock_agent.get_knowledge_base(knowledgeBaseId=knowledge_base_id)['knowledgeBase']['status']
+        return status if status in [ "ACTIVE", "FAILED", "DELETE_UNSUCCESSFUL" ] else None
+    kb_status = wait_until(kb_settled, f"Knowledge base {knowledge_base_id}")
 
     if kb_status != "ACTIVE":
         raise Exception("Bedrock Knowledgebase did not create successfully. Please check for error before proceeding") 
@@ -119,21 +192,24 @@ def _create_knowledge_base(knowledge_base_name, role_arn, embedding_model_arn, c
     )
 
     ingestion_job_id = response['ingestionJob']['ingestionJobId']
-    ingestion_job_status = response['ingestionJob']['status']
 
-    while ingestion_job_status not in ['COMPLETE', 'FAILED']:
+    def ingestion_finished():
         response = bedrock_agent.get_ingestion_job(
             knowledgeBaseId=knowledge_base_id,
             dataSourceId=data_source_id,
             ingestionJobId=ingestion_job_id
         )
-        ingestion_job_status = response['ingestionJob']['status']
-        time.sleep(5)
+        status = response['ingestionJob']['status']
+        return status if status in ['COMPLETE', 'FAILED'] else None
+    ingestion_job_status = wait_until(ingestion_finished, f"Ingestion job {ingestion_job_id}", timeout=3600, max_interval=30)
+    if ingestion_job_status == 'FAILED':
+        raise Exception(f"Ingestion job {ingestion_job_id} failed")
     return knowledge_base_id
 
 
 def create_knowledge_base(knowledge_base_name, bedrock_kb_execution_role_arn, embedding_model_arn, embedding_dim, s3_bucket, s3_prefix, oss_host, oss_collection_id, oss_collection_arn, index_name, region, credentials):
     create_index(oss_host, region, credentials, index_name, embedding_dim)
-    time.sleep(60) # sleeps until the IAM role is created successfully
+    wait_until(lambda: role_exists(bedrock_kb_execution_role_arn), f"Role {bedrock_kb_execution_role_arn}",
+               retry_if=lambda e: error_code(e) == "NoSuchEntity")
     knowledge_base_id = _create_knowledge_base(knowledge_base_name, bedrock_kb_execution_role_arn, embedding_model_arn, oss_collection_arn, index_name, s3_bucket, s3_prefix)
     return knowledge_base_id
\ No newline at end of file